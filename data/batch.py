@@ -0,0 +1,86 @@
+"""
+Generate and simulate many independent worlds across a process pool and
+stream a summary of each back as it finishes:
+
+    python -m data.batch --worlds 1000 --days 200 --processes 8
+
+Each summary is printed as one line of JSON. Worlds share nothing, so
+throughput scales with the number of processes.
+"""
+
+import os
+os.environ.setdefault("HEXGRID_HEADLESS", "1")
+
+import argparse
+import json
+import multiprocessing
+import timeit
+
+from .headless import simulate
+from .components.hexgrid import HexMap, PRODUCTS
+
+
+def summarize(hex_map, seed, generate_time, simulate_time):
+    """Return a dict of metrics describing one simulated world."""
+    islands = hex_map.islands
+    return {
+        "seed": seed,
+        "islands": len(islands),
+        "ports": len(hex_map.ports),
+        "ships": len(hex_map.ships),
+        "population": sum(island.population for island in islands),
+        "inventory": {product: sum(island.inventory[product] for island in islands)
+                      for product in PRODUCTS},
+        "generate_time": generate_time,
+        "simulate_time": simulate_time}
+
+
+def run_world(job):
+    """Build and simulate the world described by job, a (seed, num_rows,
+    num_columns, days) tuple, and return its summary."""
+    seed, num_rows, num_columns, days = job
+    start = timeit.default_timer()
+    hex_map = HexMap(num_rows, num_columns, (64, 64), seed)
+    generated = timeit.default_timer()
+    simulate(hex_map, days)
+    finished = timeit.default_timer()
+    return summarize(hex_map, seed, generated - start, finished - generated)
+
+
+def run_batch(num_worlds, num_rows=30, num_columns=40, days=100,
+              processes=None, first_seed=0):
+    """Simulate num_worlds worlds seeded first_seed, first_seed + 1, ...
+    on a pool of processes (one per core by default). Yields each world's
+    summary as soon as it is done, so results arrive out of seed order."""
+    jobs = [(first_seed + i, num_rows, num_columns, days)
+            for i in range(num_worlds)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        for summary in pool.imap_unordered(run_world, jobs):
+            yield summary
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many worlds in parallel.")
+    parser.add_argument("--worlds", type=int, default=100)
+    parser.add_argument("--rows", type=int, default=30)
+    parser.add_argument("--columns", type=int, default=40)
+    parser.add_argument("--days", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first world")
+    args = parser.parse_args()
+
+    start = timeit.default_timer()
+    for summary in run_batch(args.worlds, args.rows, args.columns, args.days,
+                             args.processes, args.seed):
+        print(json.dumps(summary, sort_keys=True))
+    elapsed = timeit.default_timer() - start
+    print("# {} worlds in {:.2f}s".format(args.worlds, elapsed))
+
+
+if __name__ == "__main__":
+    main()
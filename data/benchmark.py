@@ -0,0 +1,296 @@
+"""
+Time each phase of building, simulating and drawing worlds of several sizes
+and port counts, and compare the results against a saved baseline:
+
+    python -m data.benchmark --save benchmarks.json
+    python -m data.benchmark --compare benchmarks.json
+
+It also checks that the simulation thread keeps handing the renderer fresh
+snapshots while it is fed more steps than it can run.
+
+Rendering uses SDL's dummy video driver unless SDL_VIDEODRIVER is already
+set, so this runs without a screen. Each case is run --repeat times and
+the fastest time of each phase is kept; peak memory is measured in one
+extra run with tracemalloc (Python 3 only), so tracing never slows the
+timed runs.
+"""
+
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import json
+import platform
+import sys
+import time
+import timeit
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import pygame as pg
+
+from . import prepare
+from .components.hexgrid import HexMap, RouteTable
+from .components.simulation import SimulationWorker
+from .states.gameplay import Gameplay
+
+
+PHASES = ("grid", "continents", "islands", "routes", "ships", "warmup",
+          "paths", "island_update", "ledger_tick", "simulate", "frame",
+          "frame_zoomed")
+
+
+class PhaseTimer(object):
+    """Records the time and, when trace is True, the peak memory allocated
+    by each phase of a run."""
+    def __init__(self, trace=False):
+        self.trace = trace and tracemalloc is not None
+        self.times = {}
+        self.peaks = {}
+
+    def run(self, name, func, *args):
+        if self.trace:
+            tracemalloc.start()
+        start = timeit.default_timer()
+        result = func(*args)
+        self.times[name] = timeit.default_timer() - start
+        if self.trace:
+            self.peaks[name] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return result
+
+
+def simulate_days(hex_map, days):
+    for _ in range(days):
+        hex_map.update(hex_map.day_length)
+
+
+def update_islands(hex_map, days):
+    """Tick the economy one island at a time through Island.update, which
+    works on that island's row of the ledger, for comparison with ticking
+    every island at once with IslandLedger.tick."""
+    for _ in range(days):
+        for island in hex_map.islands:
+            island.update(hex_map.economy)
+
+
+def tick_ledger(hex_map, days):
+    for _ in range(days):
+        hex_map.ledger.tick()
+
+
+def find_paths(hex_map):
+    ports = hex_map.ports
+    for i, origin in enumerate(ports):
+        for destination in ports[i + 1:]:
+            hex_map.get_path(origin, destination, ("ocean", "shallows"))
+
+
+def draw_frames(state, num_frames, zoom):
+    """Pan state's view diagonally across the map, drawing num_frames
+    frames at zoom the way the game loop does. The simulation is not
+    advanced, so only rendering is timed."""
+    surface = prepare.SCREEN
+    dt = 16
+    state.zoom_level = 1
+    for _ in range(zoom - 1):
+        state.zoom_in()
+    max_x = max(state.hexmap.pixel_size[0] - state.zoom_size[0], 0)
+    max_y = max(state.hexmap.pixel_size[1] - state.zoom_size[1], 0)
+    step = state.scroll_speed * 4
+    for frame in range(num_frames):
+        state.topleft = (frame * step) % (max_x + 1), (frame * step) % (max_y + 1)
+        state.update(dt)
+        state.draw(surface)
+
+
+def check_snapshots(hex_map, num_frames, steps_per_frame, frame_ms=16):
+    """Run hex_map on a SimulationWorker, queueing steps_per_frame steps of
+    a whole day every frame_ms for num_frames frames, far more than it can
+    keep up with. Returns the longest run of frames that saw no new
+    snapshot and the number of steps the worker dropped."""
+    worker = SimulationWorker(hex_map)
+    worker.start()
+    clock = worker.snapshot.clock
+    stale = longest_stale = 0
+    try:
+        for _ in range(num_frames):
+            for _ in range(steps_per_frame):
+                worker.advance(hex_map.day_length)
+            time.sleep(frame_ms / 1000.)
+            if worker.snapshot.clock > clock:
+                clock = worker.snapshot.clock
+                stale = 0
+            else:
+                stale += 1
+                longest_stale = max(longest_stale, stale)
+    finally:
+        worker.stop()
+        worker.join()
+    return longest_stale, worker.dropped
+
+
+def run_case(num_rows, num_columns, num_continents, seed, days, num_frames,
+             trace=False):
+    """Build, simulate and draw one world phase by phase. Returns the
+    PhaseTimer and the world."""
+    timer = PhaseTimer(trace)
+    hex_map = timer.run("grid", HexMap, num_rows, num_columns, (64, 64), seed,
+                        False)
+
+    def make_continents():
+        hex_map.continents = hex_map.make_continents(num_continents)
+        hex_map.make_coastlines()
+
+    timer.run("continents", make_continents)
+    timer.run("islands", hex_map.make_islands)
+    route_table = timer.run("routes", RouteTable, hex_map, hex_map.ports)
+    timer.run("ships", hex_map.make_ships, route_table)
+    timer.run("warmup", hex_map.advance_days, 100)
+    timer.run("paths", find_paths, hex_map)
+    timer.run("island_update", update_islands, hex_map, days)
+    timer.run("ledger_tick", tick_ledger, hex_map, days)
+    timer.run("simulate", simulate_days, hex_map, days)
+    if num_frames:
+        #Frames are drawn from the worker's snapshot with the worker
+        #stopped, so a simulation thread doesn't compete for the GIL.
+        state = Gameplay(hex_map)
+        state.worker.stop()
+        state.worker.join()
+        timer.run("frame", draw_frames, state, num_frames, 1)
+        timer.run("frame_zoomed", draw_frames, state, num_frames, 2)
+        for name in ("frame", "frame_zoomed"):
+            timer.times[name] /= num_frames
+    return timer, hex_map
+
+
+def benchmark(sizes, continent_counts, seed=0, days=100, num_frames=120,
+              repeat=3):
+    """Run every combination of sizes, a list of (rows, columns), and
+    continent_counts. Returns a list of result dicts with each phase's
+    fastest time in ms (per frame for the frame phases) and peak memory
+    in KiB (None without tracemalloc)."""
+    results = []
+    for num_rows, num_columns in sizes:
+        for num_continents in continent_counts:
+            best = {}
+            for _ in range(repeat):
+                timer, hex_map = run_case(num_rows, num_columns, num_continents,
+                                          seed, days, num_frames)
+                for name, seconds in timer.times.items():
+                    best[name] = min(seconds, best.get(name, seconds))
+            traced, _ = run_case(num_rows, num_columns, num_continents, seed,
+                                 days, num_frames, trace=True)
+            phases = {}
+            for name in PHASES:
+                if name not in best:
+                    continue
+                peak = traced.peaks.get(name)
+                phases[name] = {
+                    "ms": best[name] * 1000,
+                    "peak_kib": None if peak is None else peak / 1024.}
+            results.append({
+                "rows": num_rows,
+                "columns": num_columns,
+                "continents": num_continents,
+                "ports": len(hex_map.ports),
+                "ships": len(hex_map.ships),
+                "phases": phases})
+    return results
+
+
+def case_key(result):
+    return result["rows"], result["columns"], result["continents"]
+
+
+def print_results(results, baseline=None, tolerance=0.2):
+    """Print each case's phases, with the ratio to the baseline's time when
+    there is one. Returns the number of phases more than tolerance slower
+    than the baseline."""
+    baseline_cases = {}
+    if baseline is not None:
+        baseline_cases = {case_key(r): r for r in baseline["results"]}
+    regressions = 0
+    for result in results:
+        print("{}x{} map, {} continents, {} ports, {} ships".format(
+                result["rows"], result["columns"], result["continents"],
+                result["ports"], result["ships"]))
+        old = baseline_cases.get(case_key(result), {}).get("phases", {})
+        for name in PHASES:
+            if name not in result["phases"]:
+                continue
+            phase = result["phases"][name]
+            line = "  {:<14}{:>10.3f} ms".format(name, phase["ms"])
+            if phase["peak_kib"] is not None:
+                line += "{:>12.1f} KiB".format(phase["peak_kib"])
+            if name in old and old[name]["ms"] > 0:
+                ratio = phase["ms"] / old[name]["ms"]
+                line += "{:>8.2f}x".format(ratio)
+                if ratio > 1 + tolerance:
+                    line += "  REGRESSION"
+                    regressions += 1
+            print(line)
+    return regressions
+
+
+def parse_pairs(text):
+    return [tuple(int(n) for n in pair.split("x")) for pair in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark world generation, simulation and rendering.")
+    parser.add_argument("--sizes", type=parse_pairs, default=parse_pairs("20x30,30x40,60x80"),
+                        help="comma separated ROWSxCOLUMNS map sizes")
+    parser.add_argument("--continents", default="4,8,16",
+                        help="comma separated continent (and so port) counts")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--days", type=int, default=100)
+    parser.add_argument("--frames", type=int, default=120,
+                        help="frames to draw per zoom level, 0 to skip rendering")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", metavar="PATH", help="write the results to PATH as a baseline")
+    parser.add_argument("--compare", metavar="PATH", help="compare against the baseline at PATH")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown beyond which a phase counts as a regression")
+    parser.add_argument("--max-stale", type=int, default=10,
+                        help="frames the renderer may go without a new snapshot under load")
+    args = parser.parse_args()
+
+    continent_counts = [int(n) for n in args.continents.split(",")]
+    results = benchmark(args.sizes, continent_counts, args.seed, args.days,
+                        args.frames, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    regressions = print_results(results, baseline, args.tolerance)
+    num_rows, num_columns = max(args.sizes, key=lambda size: size[0] * size[1])
+    hex_map = HexMap(num_rows, num_columns, (64, 64), args.seed, False)
+    hex_map.generate(max(continent_counts))
+    longest_stale, dropped = check_snapshots(hex_map, args.frames or 120, 120)
+    print("Snapshots under load: at most {} frames stale, {} steps dropped".format(
+            longest_stale, dropped))
+    stale = longest_stale > args.max_stale
+    if stale:
+        print("Snapshots went stale for more than {} frames".format(args.max_stale))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "pygame": pg.version.ver,
+                       "platform": platform.platform(),
+                       "seed": args.seed,
+                       "days": args.days,
+                       "frames": args.frames,
+                       "results": results}, f, indent=2, sort_keys=True)
+    if regressions:
+        print("{} phases regressed by more than {:.0%}".format(
+                regressions, args.tolerance))
+    if regressions or stale:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+A texture atlas: many small images packed into one surface, drawn by
+blitting areas of it. Drawing a whole layer from one source surface lets
+it go through a single Surface.blits call.
+"""
+
+import pygame as pg
+
+
+#SDL's own alpha blitter is faster than pygame's. It gives the same result
+#for opaque and fully transparent pixels and rounds partly transparent
+#ones (antialiased ship edges) within a few levels of it. Older pygames
+#without it fall back to the default blitter.
+BLEND_FLAGS = getattr(pg, "BLEND_ALPHA_SDL2", 0)
+
+
+class TextureAtlas(object):
+    """Packs images, a dict of name to Surface, into self.image in rows
+    no wider than max_width (or the widest image). areas maps each name to
+    its rect in self.image. Colorkeyed images are stored with per-pixel
+    alpha, so every image can be drawn from the one surface."""
+    def __init__(self, images, max_width=1024):
+        names = sorted(images, key=lambda name: (-images[name].get_height(), name))
+        max_width = max([max_width] + [images[n].get_width() for n in names])
+        self.areas = {}
+        x = y = row_height = width = 0
+        for name in names:
+            w, h = images[name].get_size()
+            if x + w > max_width:
+                x, y = 0, y + row_height
+                row_height = 0
+            self.areas[name] = pg.Rect(x, y, w, h)
+            x += w
+            width = max(width, x)
+            row_height = max(row_height, h)
+        self.image = pg.Surface((width, y + row_height), pg.SRCALPHA)
+        for name in names:
+            self.image.blit(images[name], self.areas[name])
+        if pg.display.get_surface() is not None:
+            self.image = self.image.convert_alpha()
+
+    def __contains__(self, name):
+        return name in self.areas
+
+    def subsurface(self, name):
+        return self.image.subsurface(self.areas[name])
+
+    def blit_item(self, name, dest):
+        """Return a (source, dest, area, flags) tuple that draws name at
+        dest, for use with blit_all."""
+        return self.image, dest, self.areas[name], BLEND_FLAGS
+
+    def scaled(self, zoom, names=None):
+        """Return a new atlas of names (all images by default) scaled up
+        by zoom."""
+        if names is None:
+            names = self.areas
+        images = {}
+        for name in names:
+            w, h = self.areas[name].size
+            images[name] = pg.transform.scale(self.subsurface(name),
+                                              (w * zoom, h * zoom))
+        return TextureAtlas(images)
+
+
+def blit_all(surface, blit_sequence):
+    """Blit every (source, dest, area, flags) in blit_sequence onto
+    surface, in one Surface.blits call where pygame has it."""
+    try:
+        blits = surface.blits
+    except AttributeError:
+        for source, dest, area, flags in blit_sequence:
+            surface.blit(source, dest, area, flags)
+    else:
+        blits(blit_sequence, doreturn=False)
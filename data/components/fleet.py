@@ -0,0 +1,90 @@
+"""
+Movement state for all the ships of a HexMap, stored as parallel arrays so
+positions can be worked out for many ships in one pass.
+"""
+
+from array import array
+
+
+class Fleet(object):
+    """Struct-of-arrays store of ship movement, indexed by ship id. Each
+    ship follows a looping route of (cell, direction) stops and hops from
+    (start_x, start_y) to (end_x, end_y) over hop_duration ms, starting at
+    depart_time."""
+    def __init__(self, hop_duration):
+        self.hop_duration = hop_duration
+        self.routes = []
+        self.route_index = array("i")
+        self.start_x = array("i")
+        self.start_y = array("i")
+        self.end_x = array("i")
+        self.end_y = array("i")
+        self.depart_time = array("d")
+
+    def __len__(self):
+        return len(self.routes)
+
+    def copy(self):
+        """Return a copy of the fleet's arrays. Routes are never changed
+        after a ship is added, so the route lists are shared."""
+        fleet = Fleet(self.hop_duration)
+        fleet.routes = self.routes[:]
+        for name in ("route_index", "start_x", "start_y", "end_x", "end_y",
+                     "depart_time"):
+            setattr(fleet, name, getattr(self, name)[:])
+        return fleet
+
+    def add_ship(self, route, pos, now):
+        """Add a ship sitting at pos at the first stop of route and return
+        its id. The ship counts as having arrived at time now."""
+        ship_id = len(self.routes)
+        self.routes.append(route)
+        self.route_index.append(0)
+        x, y = pos
+        self.start_x.append(x)
+        self.start_y.append(y)
+        self.end_x.append(x)
+        self.end_y.append(y)
+        self.depart_time.append(now - self.hop_duration)
+        return ship_id
+
+    def current_stop(self, ship_id):
+        """The (cell, direction) stop the ship is heading for."""
+        return self.routes[ship_id][self.route_index[ship_id]]
+
+    def arrival_time(self, ship_id):
+        return self.depart_time[ship_id] + self.hop_duration
+
+    def next_stop(self, ship_id, now):
+        """Start the ship's hop to the next stop of its route at time now
+        and return that (cell, direction) stop."""
+        route = self.routes[ship_id]
+        i = (self.route_index[ship_id] + 1) % len(route)
+        self.route_index[ship_id] = i
+        destination = route[i][0]
+        self.start_x[ship_id] = self.end_x[ship_id]
+        self.start_y[ship_id] = self.end_y[ship_id]
+        self.end_x[ship_id], self.end_y[ship_id] = destination.rect.topleft
+        self.depart_time[ship_id] = now
+        return route[i]
+
+    def positions(self, time, ship_ids=None):
+        """Return the interpolated topleft of each ship in ship_ids (every
+        ship if None) at time, in the same order."""
+        if ship_ids is None:
+            ship_ids = range(len(self.routes))
+        duration = float(self.hop_duration)
+        start_x, start_y = self.start_x, self.start_y
+        end_x, end_y = self.end_x, self.end_y
+        depart_time = self.depart_time
+        positions = []
+        for i in ship_ids:
+            p = (time - depart_time[i]) / duration
+            if p < 0.:
+                p = 0.
+            elif p > 1.:
+                p = 1.
+            x1, y1 = start_x[i], start_y[i]
+            positions.append((int(round(x1 + (end_x[i] - x1) * p)),
+                              int(round(y1 + (end_y[i] - y1) * p))))
+        return positions
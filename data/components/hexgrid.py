@@ -1,46 +1,175 @@
-from random import choice, sample, randint, shuffle
-from itertools import cycle
+import random
+from itertools import count
+from collections import deque
+from heapq import heappush, heappop
+from array import array
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
 
 import pygame as pg
 
 from .. import prepare
-from ..components.labels import Label
-from ..components.animation import Animation, Task
+from ..components.spatial import SpatialHash
+from ..components.fleet import Fleet
+from ..components.atlas import TextureAtlas, blit_all, BLEND_FLAGS
 
-class HexCell(pg.sprite.Sprite):
-    def __init__(self, index, rect, terrain):
-        super(HexCell, self).__init__()
+
+PRODUCTS = ("Gold", "Iron", "Wood", "Crops", "Fish")
+PRODUCT_INDICES = {product: i for i, product in enumerate(PRODUCTS)}
+
+TERRAINS = ("ocean", "shallows", "port", "plains", "jungle", "hills", "mountains")
+LAND_TERRAINS = ("plains", "jungle", "hills", "mountains")
+TERRAIN_CODES = {terrain: code for code, terrain in enumerate(TERRAINS)}
+
+#Offsets to the six neighbors of a cell, keyed by row parity
+#(odd rows are shifted half a cell to the right).
+NEIGHBOR_OFFSETS = {
+    0: ((-1, 0), (-1, -1), (0, -1), (1, 0), (0, 1), (-1, 1)),
+    1: ((-1, 0), (0, -1), (1, -1), (1, 0), (1, 1), (0, 1))}
+
+
+#Collision masks keyed by GFX image name, shared by every sprite that
+#uses the same image.
+MASKS = {}
+
+
+def get_mask(image_name):
+    """Return the cached mask for prepare.GFX[image_name]."""
+    if image_name not in MASKS:
+        MASKS[image_name] = pg.mask.from_surface(prepare.GFX[image_name])
+    return MASKS[image_name]
+
+
+#Every hex, outline and ship image the map is drawn with, packed into one
+#TextureAtlas the first time it is needed.
+ATLAS_IMAGES = (["hex-{}".format(terrain) for terrain in TERRAINS] +
+                ["outline-generic"] +
+                ["ship-{}".format(d) for d in ("e", "ne", "nw", "se", "sw", "w")])
+ATLAS = None
+
+
+def get_atlas():
+    """Return the shared TextureAtlas of ATLAS_IMAGES."""
+    global ATLAS
+    if ATLAS is None:
+        ATLAS = TextureAtlas({name: prepare.GFX[name] for name in ATLAS_IMAGES})
+    return ATLAS
+
+
+def offset_to_cube(index):
+    """Convert an (x, y) offset index (odd rows shifted right) to
+    cube coordinates."""
+    x, y = index
+    q = x - (y - (y & 1)) // 2
+    r = y
+    return q, r, -q - r
+
+
+def hex_distance(index1, index2):
+    """Number of hex steps between two offset indices."""
+    q1, r1, s1 = offset_to_cube(index1)
+    q2, r2, s2 = offset_to_cube(index2)
+    return max(abs(q1 - q2), abs(r1 - r2), abs(s1 - s2))
+
+
+class HexCell(object):
+    """A thin view of one cell of a HexMap. The cell's data lives in the
+    map's flat arrays; views are created on demand and compare equal when
+    they refer to the same cell."""
+    __slots__ = ("hex_map", "index", "id")
+
+    def __init__(self, hex_map, index):
+        self.hex_map = hex_map
         self.index = index
-        self.rect = rect
-        self.outline_rect = self.rect.inflate(8, 8)
-        self.set_terrain(terrain)
-        self.workers = 0
-        self.mask = pg.mask.from_surface(self.image)
-        self.inventory = {
-                "Gold": 0,
-                "Iron": 0,
-                "Wood": 0,
-                "Crops": 0,
-                "Fish": 0}
+        self.id = index[1] * hex_map.num_columns + index[0]
+
+    def __eq__(self, other):
+        return (isinstance(other, HexCell) and self.id == other.id
+                and self.hex_map is other.hex_map)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self.id
+
+    @property
+    def terrain(self):
+        return TERRAINS[self.hex_map.terrain[self.id]]
+
+    @property
+    def workers(self):
+        return self.hex_map.workers[self.id]
+
+    @workers.setter
+    def workers(self, value):
+        self.hex_map.workers[self.id] = value
+
+    @property
+    def island(self):
+        island_id = self.hex_map.island_ids[self.id]
+        if island_id >= 0:
+            return self.hex_map.islands[island_id]
+
+    @island.setter
+    def island(self, island):
+        self.hex_map.island_ids[self.id] = island.id
+
+    @property
+    def rect(self):
+        return self.hex_map.cell_rect(self.index)
+
+    @property
+    def image_name(self):
+        return "hex-{}".format(self.terrain)
+
+    @property
+    def image(self):
+        return prepare.GFX[self.image_name]
+
+    @property
+    def outline_img(self):
+        return prepare.GFX["outline-generic"]
+
+    @property
+    def mask(self):
+        return get_mask(self.image_name)
 
     def set_terrain(self, terrain):
-        self.terrain = terrain
-        self.image = prepare.GFX["hex-{}".format(terrain)]
-        self.outline_img = prepare.GFX["outline-generic"]
-
-    def get_neighbors(self, grid):
-        offset_indices = {
-            0: [(-1, 0), (-1, -1), (0, -1), (1, 0), (0, 1), (-1, 1)],
-            1: [(-1, 0), (0, -1), (1, -1), (1, 0), (1, 1), (0, 1)]}
-        offsets = offset_indices[self.index[1] % 2]
-        neighbors = []
-        for off in offsets:
-            try:
-                n = grid[(off[0] + self.index[0], off[1] + self.index[1])]
-                neighbors.append(n)
-            except KeyError:
-                pass
-        return neighbors
+        self.hex_map.set_terrain(self.id, terrain)
+
+    def get_neighbors(self, grid=None):
+        """Return a tuple of the cells adjacent to this one, read from the
+        map's neighbor table. This makes a new view per neighbor, so hot
+        loops should use HexMap.neighbor_ids_of on cell ids instead."""
+        hex_map = self.hex_map
+        return tuple(hex_map.get_cell(n) for n in hex_map.neighbor_ids_of(self.id))
+
+
+class CellGrid(Mapping):
+    """Read-only mapping of (x, y) indices to HexCell views of a HexMap."""
+    def __init__(self, hex_map):
+        self.hex_map = hex_map
+
+    def __getitem__(self, index):
+        if index not in self:
+            raise KeyError(index)
+        return HexCell(self.hex_map, index)
+
+    def __contains__(self, index):
+        x, y = index
+        return (0 <= x < self.hex_map.num_columns
+                and 0 <= y < self.hex_map.num_rows)
+
+    def __iter__(self):
+        for y in range(self.hex_map.num_rows):
+            for x in range(self.hex_map.num_columns):
+                yield x, y
+
+    def __len__(self):
+        return self.hex_map.num_rows * self.hex_map.num_columns
 
         
 class Economy(object):
@@ -69,9 +198,10 @@ class Economy(object):
         return self.base_prices[item] * mod
         
         
-class MerchantShip(pg.sprite.Sprite):
-    masks = {x: pg.mask.from_surface(prepare.GFX["ship-{}".format(x)])
-                  for x in ("e","w","ne","nw","se", "sw")}
+class MerchantShip(object):
+    """A handle to one ship in a HexMap's Fleet. The ship's movement lives
+    in the fleet's arrays; the handle holds its cargo and trading state."""
+    hop_duration = 1000
     directions = {
         0: {
             (1, 0): "e",
@@ -89,8 +219,6 @@ class MerchantShip(pg.sprite.Sprite):
             (1, -1): "ne"}}
             
     def __init__(self, home_port, away_port, hex_grid, economy):
-        super(MerchantShip, self).__init__()
-        self.animations = pg.sprite.Group()
         self.cargo = {
             "Gold": 0,
             "Iron": 0,
@@ -98,50 +226,65 @@ class MerchantShip(pg.sprite.Sprite):
             "Crops": 0,
             "Fish": 0}
         self.cargo_capacity = 50
+        self.rng = hex_grid.rng
         self.home_port = home_port
         self.away_port = away_port
-        route_to = hex_grid.get_path(self.home_port, self.away_port, ["ocean", "shallows"])
+        route_to = hex_grid.route_table.get_route(self.home_port, self.away_port)
         route_back = route_to[1:-1][::-1]
         route = route_to + route_back
-        self.route = []
+        stops = []
         start = route[-1]
         for i, r in enumerate(route):
             dest = r
             dx = dest.index[0] - start.index[0]
             dy = dest.index[1] - start.index[1]            
             direction = self.directions[start.index[1] % 2][(dx, dy)]
-            self.route.append((dest, direction))
+            stops.append((dest, direction))
             start = r
-        begin_direct = self.route[0][1]
-        self.route = cycle(self.route)        
-        self.image = prepare.GFX["ship-{}".format(begin_direct)]
-        self.mask = self.masks[begin_direct]
-        self.rect = self.image.get_rect(center=self.home_port.rect.center)
+        self.rect = pg.Rect((0, 0), hex_grid.cell_size)
+        self.rect.center = self.home_port.rect.center
+        self.fleet = hex_grid.fleet
+        self.id = self.fleet.add_ship(stops, self.rect.topleft, hex_grid.clock)
+        self.ship_index = hex_grid.ship_index
+        self.ship_index.add(self)
+        self.scheduler = hex_grid.scheduler
         self.port_is_destination = False
         self.next_port = None
-        next(self.route)
-        self.set_next_destination(economy)
+        self.set_next_destination(economy, hex_grid.clock)
 
-    def set_next_destination(self, economy):
+    @property
+    def direction(self):
+        return self.fleet.current_stop(self.id)[1]
+
+    @property
+    def arrival_time(self):
+        return self.fleet.arrival_time(self.id)
+
+    @property
+    def image_name(self):
+        return "ship-{}".format(self.direction)
+
+    def set_next_destination(self, economy, now):
+        """Called by the scheduler when the ship arrives at its current
+        destination at time now. Trades if the destination is a port and
+        schedules the arrival at the next cell of the route."""
         if self.port_is_destination:
             self.port_call(self.next_port.island, economy)
             self.port_is_destination = False
-        destination, direction = next(self.route)
+        destination, direction = self.fleet.next_stop(self.id, now)
         if destination.terrain == "port":
             self.port_is_destination = True
             self.next_port = destination            
-        self.image = prepare.GFX["ship-{}".format(direction)]
-        self.mask = self.masks[direction]
-        ani = Animation(left=destination.rect.left, top=destination.rect.top, duration=1000)
-        ani.start(self.rect)
-        self.animations.add(ani)
+        self.rect.topleft = self.fleet.start_x[self.id], self.fleet.start_y[self.id]
+        self.ship_index.move(self)
+        self.scheduler.schedule(self)
         
     def port_call(self, island, economy):
         for c in self.cargo:
             island.inventory[c] += self.cargo[c]
             self.cargo[c] = 0
-        products = island.inventory.keys()
-        shuffle(products)
+        products = list(PRODUCTS)
+        self.rng.shuffle(products)
         for product in products:
             need = island.population * economy.per_cap_consumption[product] * 14
             if island.inventory[product] > need:
@@ -149,17 +292,123 @@ class MerchantShip(pg.sprite.Sprite):
                 amt = min(island.inventory[product] - need, capacity)
                 self.cargo[product] += amt
                 island.inventory[product] -= amt
-            
-        
-    def update(self, dt, economy):
-        self.animations.update(dt)
-        if not self.animations:
-            self.set_next_destination(economy)
-        
-    def draw(self, surface):
-        surface.blit(self.image, self.rect)
-        
-    
+
+
+class ShipScheduler(object):
+    """Priority queue of ship arrivals keyed on arrival time. Ships are
+    only touched when they arrive somewhere, not every frame."""
+    def __init__(self):
+        self.queue = []
+        self.tiebreak = count()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def schedule(self, ship):
+        heappush(self.queue, (ship.arrival_time, next(self.tiebreak), ship))
+
+    def run_until(self, time, economy):
+        """Process every arrival at or before time, in arrival order."""
+        queue = self.queue
+        while queue and queue[0][0] <= time:
+            arrival_time, _, ship = heappop(queue)
+            ship.set_next_destination(economy, arrival_time)
+
+
+class RouteTable(object):
+    """Shortest sea routes between every pair of ports. Each port gets a
+    single breadth-first search that covers all the ports after it in the
+    list; the route in the opposite direction is the same route reversed.
+    With no hex_map the table starts empty and routes are added with
+    add_route."""
+    def __init__(self, hex_map=None, ports=(), valid_terrains=("ocean", "shallows")):
+        self.routes = {}
+        for i, port in enumerate(ports):
+            targets = ports[i + 1:]
+            if not targets:
+                continue
+            parents = hex_map.find_paths_from(port.id, [t.id for t in targets],
+                                              valid_terrains)
+            for target in targets:
+                if target.id not in parents:
+                    continue
+                route = []
+                cell_id = target.id
+                while cell_id is not None:
+                    route.append(hex_map.get_cell(cell_id))
+                    cell_id = parents[cell_id]
+                route.reverse()
+                self.add_route(route)
+
+    def add_route(self, route):
+        """Store route, a list of cells, and its reverse."""
+        self.routes[(route[0], route[-1])] = route
+        self.routes[(route[-1], route[0])] = route[::-1]
+
+    def get_route(self, origin, destination):
+        """Return the list of cells from origin to destination or None if
+        there is no sea route between them."""
+        return self.routes.get((origin, destination))
+
+
+class IslandLedger(object):
+    """Inventory, daily production and daily consumption of every island,
+    held as islands x products matrices in flat row-major arrays so a day
+    for all islands is a single pass over the arrays."""
+    def __init__(self, num_islands):
+        size = num_islands * len(PRODUCTS)
+        self.inventory = array("d", [0.]) * size
+        self.production = array("d", [0.]) * size
+        self.consumption = array("d", [0.]) * size
+
+    def set_rates(self, island_id, production, consumption):
+        """Set an island's daily production and consumption from dicts
+        keyed by product."""
+        row = island_id * len(PRODUCTS)
+        for i, product in enumerate(PRODUCTS):
+            self.production[row + i] = production[product]
+            self.consumption[row + i] = consumption[product]
+
+    def tick(self):
+        """Add one day of production, subtract one day of consumption and
+        clamp at zero for every island and product."""
+        self.inventory[:] = array("d", [
+                max(0., v + p - c) for v, p, c in
+                zip(self.inventory, self.production, self.consumption)])
+
+    def advance(self, days):
+        """Apply days days of production and consumption in one step.
+        Net daily change is constant, so a stock either grows steadily or
+        falls until it hits zero and stays there; either way the result of
+        days ticks is max(0, inventory + days * (production - consumption))."""
+        self.inventory[:] = array("d", [
+                max(0., v + days * (p - c)) for v, p, c in
+                zip(self.inventory, self.production, self.consumption)])
+
+
+class Inventory(MutableMapping):
+    """Dict-like view of one island's row of an IslandLedger's inventory,
+    keyed by product. Products can be changed but not added or removed."""
+    def __init__(self, ledger, island_id):
+        self.ledger = ledger
+        self.row = island_id * len(PRODUCTS)
+
+    def __getitem__(self, product):
+        return self.ledger.inventory[self.row + PRODUCT_INDICES[product]]
+
+    def __setitem__(self, product, amount):
+        self.ledger.inventory[self.row + PRODUCT_INDICES[product]] = amount
+
+    def __delitem__(self, product):
+        raise TypeError("Products can't be removed from an Inventory")
+
+    def __iter__(self):
+        return iter(PRODUCTS)
+
+    def __len__(self):
+        return len(PRODUCTS)
+
+
 class Island(object):
     terrain_products = {
         "mountains": "Gold",
@@ -168,24 +417,36 @@ class Island(object):
         "plains": "Crops",
         "shallows": "Fish"}
         
-    def __init__(self, cells):
-        self.inventory = {
-            "Gold": 0,
-            "Iron": 0,
-            "Wood": 0,
-            "Crops": 0,
-            "Fish": 0}
+    def __init__(self, cells, island_id, ledger, economy, rng, population=None):
+        """Workers are assigned at random unless population is given, in
+        which case they are taken to be on the map already (as when a
+        world is loaded from disk)."""
+        self.id = island_id
+        self.rng = rng
+        self.ledger = ledger
+        self.inventory = Inventory(ledger, island_id)
         self.cells = cells
         for c in self.cells:
             c.island = self
-        self.population = randint(5, 15)
         self.working_cells = [x for x in self.cells if not x.terrain == "port"]
-        self.port = [x for x in self.cells if x not in self.working_cells][0]
-        self.assign_workers()
+        ports = [x for x in self.cells if x not in self.working_cells]
+        self.port = ports[0] if ports else None
+        if population is None:
+            self.population = self.rng.randint(5, 15)
+            self.assign_workers()
+        else:
+            self.population = population
+        self.refresh_rates(economy)
+
+    def refresh_rates(self, economy):
+        """Store this island's production and consumption in the ledger.
+        Call again whenever workers or population change."""
+        self.ledger.set_rates(self.id, self.calc_production(),
+                              self.calc_consumption(economy))
         
     def assign_workers(self):
         for _ in range(self.population):
-            cell = choice(self.working_cells)
+            cell = self.rng.choice(self.working_cells)
             cell.workers += 1
             
     def calc_consumption(self, economy):
@@ -205,158 +466,324 @@ class Island(object):
         return production            
         
     def update(self, economy):
-        production = self.calc_production()
-        for product in production:
-            self.inventory[product] += production[product]
-        consumption = self.calc_consumption(economy)
-        for p in consumption:
-            self.inventory[p] -= consumption[p]
-            if self.inventory[p] < 0:
-                self.inventory[p] = 0
+        """Run one day for this island alone. HexMap ticks every island at
+        once through its IslandLedger instead."""
+        ledger = self.ledger
+        row = self.id * len(PRODUCTS)
+        for i in range(row, row + len(PRODUCTS)):
+            amount = ledger.inventory[i] + ledger.production[i] - ledger.consumption[i]
+            ledger.inventory[i] = max(0., amount)
            
     
 class HexMap(object):
-    def __init__(self, num_rows, num_columns, cell_size):
+    """A randomly generated map of islands and the ships trading between
+    them. All generation and trading randomness comes from self.rng, built
+    from seed, so the same seed and size always give the same world. A
+    seed is picked at random if none is given. With generate=False the
+    map is left as empty ocean for a loader to fill in."""
+    def __init__(self, num_rows, num_columns, cell_size, seed=None, generate=True):
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+        self.seed = seed
+        self.rng = random.Random(seed)
         self.num_rows = num_rows
         self.num_columns = num_columns
         self.cell_size = cell_size
+        self.terrain_callbacks = []
+        self.clock = 0
+        self.scheduler = ShipScheduler()
         self.make_grid()
-        num_continents = randint(4, 7)
-        self.continents = self.make_continents(num_continents)
-        
-        self.make_coastlines()
-        self.islands = [Island(continent) for continent in self.continents]
-        self.topleft = (0, 0)
         self.economy = Economy()
-        self.make_ships()
+        self.topleft = (0, 0)
         self.day_length = 2000
         self.day_timer = 0
-        for _ in range(100):
-            for island in self.islands:
-                island.update(self.economy)
+        if generate:
+            self.generate()
+
+    def generate(self, num_continents=None, progress=None):
+        """Build continents, coastlines, islands and ships from self.rng,
+        then run 100 days of the economy to stock the islands. Each
+        continent gets one port; by default there are 4 to 7 of them.
+        progress, if given, is called as progress(fraction, message) before
+        each step with the fraction of the work already done."""
+        if progress is None:
+            progress = lambda fraction, message: None
+        if num_continents is None:
+            num_continents = self.rng.randint(4, 7)
+        progress(0., "Raising continents")
+        self.continents = self.make_continents(num_continents)
+        progress(.2, "Drawing coastlines")
+        self.make_coastlines()
+        progress(.3, "Settling islands")
+        self.make_islands()
+        progress(.4, "Charting trade routes")
+        self.make_ships()
+        progress(.9, "Stocking islands")
+        self.advance_days(100)
+        progress(1., "Done")
+
+    def make_islands(self, populations=None):
+        """Make an Island of each continent. populations, if given, lists
+        each island's population and means workers are already placed."""
+        if populations is None:
+            populations = [None] * len(self.continents)
+        self.ledger = IslandLedger(len(self.continents))
+        self.islands = [Island(continent, i, self.ledger, self.economy,
+                               self.rng, population)
+                        for i, (continent, population)
+                        in enumerate(zip(self.continents, populations))]
+        #Continents can share coast cells, so an island's production is
+        #only final once every later island has placed its workers.
+        for island in self.islands:
+            island.refresh_rates(self.economy)
 
     def update(self, dt):
+        """Advance the simulation by dt ms. Ship arrivals before a day
+        boundary are handled before the islands' daily update."""
         self.day_timer += dt
         if self.day_timer >= self.day_length:
             self.day_timer -= self.day_length
-            for island in self.islands:
-                island.update(self.economy)
-        for ship in self.ships:
-            ship.update(dt, self.economy)    
-       
-    def make_ships(self):
+            self.scheduler.run_until(self.clock + dt - self.day_timer, self.economy)
+            self.ledger.tick()
+        self.clock += dt
+        self.scheduler.run_until(self.clock, self.economy)
+
+    def advance_days(self, days):
+        """Jump every island's inventory days days ahead in one batched step.
+        Only production and consumption are applied; ships do not move
+        and no trades happen."""
+        if days > 0:
+            self.ledger.advance(days)
+
+    def make_ships(self, route_table=None):
+        """Put a ship on every port-to-port route, building the route table
+        first unless one is given."""
+        if route_table is None:
+            route_table = RouteTable(self, self.ports)
+        self.route_table = route_table
+        #Ships are indexed where their current hop starts, so queries are
+        #padded by a ship's half size plus one hop.
+        self.ship_index = SpatialHash(self.cell_size[0] * 2,
+                                      max(self.cell_size) * 3 // 2)
+        self.fleet = Fleet(MerchantShip.hop_duration)
         self.ships = []
         for port in self.ports:
             other_ports = [x for x in self.ports if x != port]
             for other in other_ports:
+                if self.route_table.get_route(port, other) is None:
+                    continue
                 ship = MerchantShip(port, other, self, self.economy)
                 self.ships.append(ship)    
 
     def make_grid(self):
-        row_offset = 32
-        column_offset = 48
-        w, h  = self.cell_size
-        self.grid = {}
+        """Allocate the flat per-cell arrays and the neighbor table. Cell
+        ids are y * num_columns + x."""
+        self.row_offset = 32
+        self.column_offset = 48
+        num_cells = self.num_rows * self.num_columns
+        self.terrain = array("B", [TERRAIN_CODES["ocean"]]) * num_cells
+        self.workers = array("H", [0]) * num_cells
+        self.island_ids = array("h", [-1]) * num_cells
+        self.neighbor_ids = array("i", [-1]) * (num_cells * 6)
+        i = 0
         for y in range(self.num_rows):
             for x in range(self.num_columns):
-                left = (row_offset * (y%2)) + (w * x)
-                top = (column_offset * y)
-                rect = pg.Rect(left, top, w, h)
-                self.grid[(x, y)] = HexCell((x, y), rect, "ocean")
-    
+                for dx, dy in NEIGHBOR_OFFSETS[y % 2]:
+                    nx, ny = x + dx, y + dy
+                    if 0 <= nx < self.num_columns and 0 <= ny < self.num_rows:
+                        self.neighbor_ids[i] = ny * self.num_columns + nx
+                    i += 1
+        self.grid = CellGrid(self)
+        w, h = self.cell_size
+        self.pixel_size = (self.num_columns * w,
+                           int((self.num_rows // 2) * h * 1.5))
+
+    def set_terrain(self, cell_id, terrain):
+        """Change a cell's terrain and tell every callback in
+        terrain_callbacks which cell changed."""
+        self.terrain[cell_id] = TERRAIN_CODES[terrain]
+        for callback in self.terrain_callbacks:
+            callback(cell_id)
+
+    def get_cell(self, cell_id):
+        return HexCell(self, (cell_id % self.num_columns,
+                              cell_id // self.num_columns))
+
+    def neighbor_ids_of(self, cell_id):
+        start = cell_id * 6
+        return [n for n in self.neighbor_ids[start:start + 6] if n >= 0]
+
+    def cell_rect(self, index):
+        x, y = index
+        w, h = self.cell_size
+        left = (self.row_offset * (y % 2)) + (w * x)
+        top = self.column_offset * y
+        return pg.Rect(left, top, w, h)
+
     def get_continent_spots(self, num_continents):
         xes = range(3, self.num_columns - 3)
         ys = range(3, self.num_rows - 3)
         spots = [(x, y) for x in xes for y in ys]
-        return sample(spots, num_continents)
+        return self.rng.sample(spots, num_continents)
 
     def make_continents(self, num_continents):
+        """Grow num_continents continents at random spots. Works on cell
+        ids and returns each continent as a list of cells."""
+        terrain = self.terrain
+        ocean = TERRAIN_CODES["ocean"]
+        expandable = (TERRAIN_CODES["hills"], TERRAIN_CODES["jungle"])
+        neighbors_of = self.neighbor_ids_of
         spots = self.get_continent_spots(num_continents)
         continents = []
-        for spot in spots:
+        for x, y in spots:
+            spot = y * self.num_columns + x
             continent = []
-            num_cells = randint(5, 15)
-            num_mountains = randint(0, 2)
+            num_cells = self.rng.randint(5, 15)
+            num_mountains = self.rng.randint(0, 2)
             if num_mountains:
-                self.grid[spot].set_terrain("mountains")
-                continent.append(self.grid[spot])
-                neighbors = [x for x in self.grid[spot].get_neighbors(self.grid) if x not in continent]
+                self.set_terrain(spot, "mountains")
+                continent.append(spot)
+                neighbors = [n for n in neighbors_of(spot) if n not in continent]
                 for _ in range(num_mountains - 1):
-                    s = choice(neighbors)
-                    s.set_terrain("mountains")
+                    s = self.rng.choice(neighbors)
+                    self.set_terrain(s, "mountains")
                     continent.append(s)
-                    neighbors = [x for x in s.get_neighbors(self.grid) if x not in continent]
+                    neighbors = [n for n in neighbors_of(s) if n not in continent]
                 hills = []
                 for m in continent:
-                    neighbors_ = [x for x in m.get_neighbors(self.grid) if x not in continent and x not in hills]
+                    neighbors_ = [n for n in neighbors_of(m) if n not in continent and n not in hills]
                     for n_ in neighbors_:
-                        n_.set_terrain("hills")
+                        self.set_terrain(n_, "hills")
                         hills.append(n_)
                 continent.extend(hills)
             else:
-                self.grid[spot].set_terrain("jungle")
-                continent.append(self.grid[spot])
-            for m_ in [x for x in continent if x.terrain in ["hills", "jungle"]]:
-                neighb = [x for x in m_.get_neighbors(self.grid) if x not in continent and x.terrain == "ocean"]
+                self.set_terrain(spot, "jungle")
+                continent.append(spot)
+            for m_ in [c for c in continent if terrain[c] in expandable]:
+                neighb = [n for n in neighbors_of(m_) if n not in continent and terrain[n] == ocean]
                 for neigh in neighb:
-                    neigh.set_terrain("jungle")
+                    self.set_terrain(neigh, "jungle")
                     continent.append(neigh)
                     
             cells_left = num_cells
-            starts = [x for x in continent if x.terrain in ("jungle", "hills")]
+            starts = [c for c in continent if terrain[c] in expandable]
             attempts = 0
             while cells_left and attempts < 200:
                 attempts += 1
-                expander = choice(starts)
-                possible = [t for t in expander.get_neighbors(self.grid) if t.terrain == "ocean"]
+                expander = self.rng.choice(starts)
+                possible = [t for t in neighbors_of(expander) if terrain[t] == ocean]
                 if possible:
-                    expand = choice(possible)
-                    expand.set_terrain(choice(["plains", "jungle"]))
+                    expand = self.rng.choice(possible)
+                    self.set_terrain(expand, self.rng.choice(["plains", "jungle"]))
                     continent.append(expand)
                     cells_left -= 1
                     starts.append(expand) 
-            continents.append(continent)
+            continents.append([self.get_cell(c) for c in continent])
         return continents
         
     def make_coastlines(self):
+        terrain = self.terrain
+        ocean = TERRAIN_CODES["ocean"]
+        plains = TERRAIN_CODES["plains"]
+        land = {TERRAIN_CODES[t] for t in LAND_TERRAINS}
         self.ports = []
         for continent in self.continents:
             port_added = False
+            fallback = None
             coast = []
             for cell in continent:
-                for n in cell.get_neighbors(self.grid):  
-                    if n.terrain == "ocean":
-                        if cell.terrain == "plains" and not port_added:
+                cell_id = cell.id
+                for n in self.neighbor_ids_of(cell_id):
+                    if terrain[n] == ocean:
+                        if terrain[cell_id] == plains and not port_added:
                             cell.set_terrain("port")
                             port_added = True
                             self.ports.append(cell)
-                        n.set_terrain("shallows")
+                        elif fallback is None and terrain[cell_id] in land:
+                            fallback = cell
+                        self.set_terrain(n, "shallows")
                         coast.append(n)
-            continent.extend(coast)            
+            #Continents without coastal plains get their port on the first
+            #coastal land cell instead.
+            if not port_added and fallback is not None:
+                fallback.set_terrain("port")
+                self.ports.append(fallback)
+            continent.extend(self.get_cell(n) for n in coast)
             
+    def cell_at(self, world_pos):
+        """Return the cell under the world pixel position world_pos or None.
+        Below the pointed top of a row the cell follows directly from the
+        row layout; in the band where a row's points interleave with the
+        row above, the cell's mask decides between the two."""
+        px, py = world_pos
+        w, h = self.cell_size
+        row = py // self.column_offset
+        column = (px - self.row_offset * (row % 2)) // w
+        cell = self.grid.get((column, row))
+        if py - row * self.column_offset >= h - self.column_offset:
+            return cell
+        if cell is not None:
+            rect = cell.rect
+            if cell.mask.get_at((px - rect.left, py - rect.top)):
+                return cell
+        row -= 1
+        column = (px - self.row_offset * (row % 2)) // w
+        return self.grid.get((column, row))
+
+    def draw_cells(self, surface, area):
+        """Draw every cell overlapping area, a rect in world pixels, onto
+        surface. The topleft of surface is placed at area.topleft."""
+        w, h = self.cell_size
+        top = max(0, (area.top - h) // self.column_offset)
+        bottom = min(self.num_rows - 1, (area.bottom - 1) // self.column_offset)
+        left = max(0, (area.left - w - self.row_offset) // w)
+        right = min(self.num_columns - 1, (area.right - 1) // w)
+        atlas = get_atlas()
+        outline = atlas.areas["outline-generic"]
+        hexes = [atlas.areas["hex-{}".format(terrain)] for terrain in TERRAINS]
+        terrain = self.terrain
+        num_columns = self.num_columns
+        image = atlas.image
+        blit_sequence = []
+        for y in range(top, bottom + 1):
+            row_left = (y % 2) * self.row_offset - area.left
+            row_top = y * self.column_offset - area.top
+            for x in range(left, right + 1):
+                dest = (row_left + x * w, row_top)
+                blit_sequence.append((image, dest,
+                                      hexes[terrain[y * num_columns + x]],
+                                      BLEND_FLAGS))
+                blit_sequence.append((image, dest, outline, BLEND_FLAGS))
+        blit_all(surface, blit_sequence)
+
     def make_surface(self):
-        surf = pg.Surface((self.num_columns * self.cell_size[0], int( (self.num_rows // 2) * self.cell_size[1] * 1.5)))
-        for cell in self.grid.values():
-            surf.blit(cell.image, cell.rect)
-            surf.blit(cell.outline_img, cell.rect)
+        """Bake the whole map into self.image. Only practical for small
+        maps; the game draws through a terrain_layer.TerrainLayer."""
+        surf = pg.Surface(self.pixel_size)
+        self.draw_cells(surf, surf.get_rect())
         self.image = surf
 
     def find_path_to(self, origin, destination, valid_terrains):
-        origin = origin
-        destination = destination
+        """The original level-by-level breadth-first search. Returns a list
+        of levels of (cell, parent) pairs for backtrack, or None if
+        destination can't be reached."""
+        valid = {TERRAIN_CODES[t] for t in valid_terrains}
+        terrain = self.terrain
+        get_cell = self.get_cell
+        destination_id = destination.id
         visited = set()
-        levels = [[(origin, origin)]]
+        levels = [[(origin.id, origin.id)]]
         while True:
             neighbors = []
-            for cell, parent in levels[-1]:
-                candidates = cell.get_neighbors(self.grid)
-                for c in candidates:
-                    if c == destination:
-                        levels.append([(c, cell)])
-                        return levels
-                    if c not in visited and c.terrain in valid_terrains:
-                        neighbors.append((c, cell))
-                    visited.add(c)
+            for cell_id, parent in levels[-1]:
+                for n in self.neighbor_ids_of(cell_id):
+                    if n == destination_id:
+                        levels.append([(n, cell_id)])
+                        return [[(get_cell(c), get_cell(p)) for c, p in level]
+                                for level in levels]
+                    if n not in visited and terrain[n] in valid:
+                        neighbors.append((n, cell_id))
+                    visited.add(n)
             if neighbors:
                 levels.append(neighbors)
             else:
@@ -374,7 +801,78 @@ class HexMap(object):
                     route.append(parent)
                     break
 
-    def get_path(self, origin, destination, valid_terrains):
-        to = self.find_path_to(origin, destination, valid_terrains)
-        if to:
-            return self.backtrack(to)
+    def find_paths_from(self, origin_id, target_ids, valid_terrains):
+        """Breadth-first search outward from the cell origin_id over cells
+        whose terrain is in valid_terrains. Targets are reachable whatever
+        their terrain but are not expanded. Stops once every target has
+        been reached and returns a dict mapping each visited cell id to its
+        parent's id (the origin maps to None)."""
+        valid = {TERRAIN_CODES[t] for t in valid_terrains}
+        terrain = self.terrain
+        neighbor_ids = self.neighbor_ids
+        parents = {origin_id: None}
+        remaining = set(target_ids)
+        remaining.discard(origin_id)
+        queue = deque([origin_id])
+        while queue and remaining:
+            cell_id = queue.popleft()
+            start = cell_id * 6
+            for n in neighbor_ids[start:start + 6]:
+                if n < 0 or n in parents:
+                    continue
+                if n in remaining:
+                    parents[n] = cell_id
+                    remaining.discard(n)
+                elif terrain[n] in valid:
+                    parents[n] = cell_id
+                    queue.append(n)
+        return parents
+
+    def find_path_astar(self, origin, destination, valid_terrains):
+        """A* search from origin to destination over cells whose terrain is
+        in valid_terrains, using hex distance as the heuristic. Returns the
+        list of cells from origin to destination or None if unreachable."""
+        valid = {TERRAIN_CODES[t] for t in valid_terrains}
+        terrain = self.terrain
+        neighbor_ids = self.neighbor_ids
+        columns = self.num_columns
+        goal_id = destination.id
+        goal = destination.index
+        tiebreak = count()
+        frontier = [(hex_distance(origin.index, goal), next(tiebreak), origin.id)]
+        parents = {origin.id: None}
+        costs = {origin.id: 0}
+        closed = set()
+        while frontier:
+            _, _, cell_id = heappop(frontier)
+            if cell_id in closed:
+                continue
+            closed.add(cell_id)
+            if cell_id == goal_id:
+                route = []
+                while cell_id is not None:
+                    route.append(self.get_cell(cell_id))
+                    cell_id = parents[cell_id]
+                return route[::-1]
+            cost = costs[cell_id] + 1
+            start = cell_id * 6
+            for n in neighbor_ids[start:start + 6]:
+                if n < 0 or (n != goal_id and terrain[n] not in valid):
+                    continue
+                if n not in costs or cost < costs[n]:
+                    costs[n] = cost
+                    parents[n] = cell_id
+                    h = hex_distance((n % columns, n // columns), goal)
+                    heappush(frontier, (cost + h, next(tiebreak), n))
+
+    def get_path(self, origin, destination, valid_terrains, method="astar"):
+        """Return a list of cells from origin to destination. method selects
+        the search: "astar" (default) or the original breadth-first "bfs"."""
+        if method == "astar":
+            return self.find_path_astar(origin, destination, valid_terrains)
+        elif method == "bfs":
+            to = self.find_path_to(origin, destination, valid_terrains)
+            if to:
+                return self.backtrack(to)
+        else:
+            raise ValueError("Unknown pathfinding method: {}".format(method))
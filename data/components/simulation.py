@@ -0,0 +1,107 @@
+"""
+Runs a HexMap's simulation on a background thread and hands immutable
+snapshots of its state to the renderer.
+"""
+
+import threading
+from collections import deque
+from timeit import default_timer
+
+from .. import tools
+from ..components.hexgrid import PRODUCTS
+
+
+class Snapshot(object):
+    """A frozen copy of what the renderer needs from a HexMap: the clock,
+    ship movement, the ship spatial index, island inventories and ship
+    cargo. Taken on the simulation thread and never changed afterwards, so
+    the main thread can read it freely while the simulation moves on."""
+    def __init__(self, hex_map):
+        self.clock = hex_map.clock
+        self.fleet = hex_map.fleet.copy()
+        self.ship_index = hex_map.ship_index.copy()
+        self.inventory = hex_map.ledger.inventory[:]
+        self.cargo = {ship.id: dict(ship.cargo) for ship in hex_map.ships}
+
+    def island_inventory(self, island_id):
+        """Return a dict of product to amount held by the island."""
+        row = island_id * len(PRODUCTS)
+        return {product: self.inventory[row + i]
+                for i, product in enumerate(PRODUCTS)}
+
+    def ships_near(self, rect):
+        """Return (ship, topleft, image name) for each ship that may overlap
+        rect, positioned at the snapshot's clock."""
+        ships = self.ship_index.query_rect(rect)
+        fleet = self.fleet
+        positions = fleet.positions(self.clock, [ship.id for ship in ships])
+        return [(ship, pos, "ship-{}".format(fleet.current_stop(ship.id)[1]))
+                for ship, pos in zip(ships, positions)]
+
+
+class SimulationWorker(threading.Thread):
+    """Daemon thread that owns a HexMap's simulation. The main thread
+    queues simulated time with advance and reads the latest Snapshot from
+    snapshot. The worker builds each new snapshot while the renderer reads
+    the previous one and then swaps the reference, so neither side waits
+    on the other.
+
+    At most max_pending steps are queued. When the simulation can't keep
+    up, further steps are dropped (and counted in dropped) rather than
+    letting it fall ever further behind, as Control.simulate does with
+    steps beyond its per-frame limit. Each step's time is recorded in
+    tools.PROFILER as "sim step".
+
+    Steps are run in batches of at most those queued when the batch
+    starts, cut short once batch_ms have passed, and a snapshot is taken
+    after every batch. Even while the simulation is behind and steps are
+    being dropped, the renderer gets fresh state about once a frame."""
+    def __init__(self, hex_map, max_pending=120, batch_ms=16):
+        super(SimulationWorker, self).__init__()
+        self.daemon = True
+        self.hex_map = hex_map
+        self.max_pending = max_pending
+        self.batch_ms = batch_ms
+        self.pending = deque()
+        self.dropped = 0
+        self.wake = threading.Event()
+        self.done = False
+        self.snapshot = Snapshot(hex_map)
+
+    def advance(self, dt):
+        """Queue one simulation step of dt ms, or drop it if max_pending
+        steps are already waiting. Does not block."""
+        if len(self.pending) < self.max_pending:
+            self.pending.append(dt)
+        else:
+            self.dropped += 1
+        self.wake.set()
+
+    def stop(self):
+        self.done = True
+        self.wake.set()
+
+    def run(self):
+        while not self.done:
+            if not self.pending:
+                self.wake.wait()
+                self.wake.clear()
+            self.run_batch()
+
+    def run_batch(self):
+        """Run the steps queued now, stopping early once batch_ms have
+        passed, then publish a new snapshot if any step ran."""
+        deadline = default_timer() + self.batch_ms / 1000.
+        stepped = False
+        for _ in range(len(self.pending)):
+            if self.done:
+                break
+            start = default_timer()
+            self.hex_map.update(self.pending.popleft())
+            end = default_timer()
+            tools.PROFILER.record("sim step", (end - start) * 1000)
+            stepped = True
+            if end >= deadline:
+                break
+        if stepped:
+            self.snapshot = Snapshot(self.hex_map)
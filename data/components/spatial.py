@@ -0,0 +1,66 @@
+"""
+A uniform grid spatial hash for finding sprites near a point or inside a
+rect without checking every sprite.
+"""
+
+import pygame as pg
+
+
+class SpatialHash(object):
+    """Buckets objects with a rect attribute by the grid square containing
+    their rect's center. Call move whenever an object's rect changes.
+    pad should be at least half the size of the largest rect stored so that
+    queries also find objects whose center lies just outside the area."""
+    def __init__(self, bucket_size, pad=0):
+        self.bucket_size = bucket_size
+        self.pad = pad
+        self.buckets = {}
+        self.keys = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def copy(self):
+        spatial_hash = SpatialHash(self.bucket_size, self.pad)
+        spatial_hash.buckets = {key: set(bucket)
+                                for key, bucket in self.buckets.items()}
+        spatial_hash.keys = dict(self.keys)
+        return spatial_hash
+
+    def get_key(self, pos):
+        return pos[0] // self.bucket_size, pos[1] // self.bucket_size
+
+    def add(self, obj):
+        key = self.get_key(obj.rect.center)
+        self.buckets.setdefault(key, set()).add(obj)
+        self.keys[obj] = key
+
+    def remove(self, obj):
+        key = self.keys.pop(obj)
+        bucket = self.buckets[key]
+        bucket.discard(obj)
+        if not bucket:
+            del self.buckets[key]
+
+    def move(self, obj):
+        """Rebucket obj if its rect's center has changed buckets."""
+        key = self.get_key(obj.rect.center)
+        if self.keys.get(obj) != key:
+            if obj in self.keys:
+                self.remove(obj)
+            self.buckets.setdefault(key, set()).add(obj)
+            self.keys[obj] = key
+
+    def query_rect(self, rect):
+        """Return a list of objects whose center lies within rect grown by
+        pad on every side."""
+        area = pg.Rect(rect).inflate(self.pad * 2, self.pad * 2)
+        left, top = self.get_key(area.topleft)
+        right, bottom = self.get_key((area.right - 1, area.bottom - 1))
+        found = []
+        for y in range(top, bottom + 1):
+            for x in range(left, right + 1):
+                bucket = self.buckets.get((x, y))
+                if bucket:
+                    found.extend(bucket)
+        return found
@@ -0,0 +1,135 @@
+"""
+The baked terrain of a HexMap, split into tiles that are rendered when
+first seen, plus a cache of those tiles pre-scaled for each zoom level.
+"""
+
+from collections import OrderedDict
+
+import pygame as pg
+
+
+class TerrainLayer(object):
+    """The terrain of a HexMap cut into square tiles of tile_size pixels.
+    A tile is rendered from the map's cells the first time any part of it
+    is drawn. Tiles far from the view can be dropped with evict and are
+    re-rendered if they come back into view. When a cell's terrain changes
+    only the tiles it overlaps are dropped, and every callback in
+    invalidate_callbacks is called with the cell's rect."""
+    def __init__(self, hex_map, tile_size=512, keep_distance=2):
+        self.hex_map = hex_map
+        self.tile_size = tile_size
+        self.keep_distance = keep_distance
+        self.rect = pg.Rect((0, 0), hex_map.pixel_size)
+        self.tiles = {}
+        self.invalidate_callbacks = []
+        hex_map.terrain_callbacks.append(self.invalidate_cell)
+
+    def get_rect(self):
+        return self.rect.copy()
+
+    def tile_keys(self, area):
+        """Keys of all tiles overlapping area."""
+        area = area.clip(self.rect)
+        if not area:
+            return []
+        size = self.tile_size
+        return [(x, y)
+                for y in range(area.top // size, (area.bottom - 1) // size + 1)
+                for x in range(area.left // size, (area.right - 1) // size + 1)]
+
+    def tile_rect(self, key):
+        size = self.tile_size
+        rect = pg.Rect(key[0] * size, key[1] * size, size, size)
+        return rect.clip(self.rect)
+
+    def get_tile(self, key):
+        if key not in self.tiles:
+            rect = self.tile_rect(key)
+            tile = pg.Surface(rect.size)
+            self.hex_map.draw_cells(tile, rect)
+            self.tiles[key] = tile
+        return self.tiles[key]
+
+    def draw_area(self, surface, area, dest=(0, 0)):
+        """Blit the terrain inside area, a rect in world pixels, onto surface
+        with area's topleft placed at dest."""
+        for key in self.tile_keys(area):
+            rect = self.tile_rect(key)
+            clip = area.clip(rect)
+            pos = (clip.left - area.left + dest[0], clip.top - area.top + dest[1])
+            surface.blit(self.get_tile(key), pos, clip.move(-rect.left, -rect.top))
+
+    def evict(self, view):
+        """Drop rendered tiles more than keep_distance tiles from view."""
+        size = self.tile_size
+        left, top = view.left // size, view.top // size
+        right, bottom = (view.right - 1) // size, (view.bottom - 1) // size
+        keep = self.keep_distance
+        for x, y in list(self.tiles):
+            if (x < left - keep or x > right + keep
+                    or y < top - keep or y > bottom + keep):
+                del self.tiles[(x, y)]
+
+    def invalidate_cell(self, cell_id):
+        rect = self.hex_map.get_cell(cell_id).rect
+        for key in self.tile_keys(rect):
+            self.tiles.pop(key, None)
+        for callback in self.invalidate_callbacks:
+            callback(rect)
+
+
+class ScaledTerrainCache(object):
+    """Pieces of a TerrainLayer pre-scaled for each zoom level. Each
+    chunk covers chunk_size screen pixels once scaled, so chunks cost the
+    same memory at every zoom level. At most max_chunks are kept; the least
+    recently drawn chunk is dropped first."""
+    def __init__(self, source, chunk_size=256, max_chunks=128):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.chunks = OrderedDict()
+
+    def world_chunk_size(self, zoom):
+        return max(1, self.chunk_size // zoom)
+
+    def get_chunk(self, zoom, chunk_x, chunk_y):
+        """Return the chunk at chunk_x, chunk_y of the zoom level's chunk
+        grid, scaling it on first use."""
+        key = zoom, chunk_x, chunk_y
+        chunk = self.chunks.pop(key, None)
+        if chunk is None:
+            size = self.world_chunk_size(zoom)
+            area = pg.Rect(chunk_x * size, chunk_y * size, size, size)
+            area = area.clip(self.source.get_rect())
+            unscaled = pg.Surface(area.size)
+            self.source.draw_area(unscaled, area)
+            chunk = pg.transform.scale(unscaled, (area.w * zoom, area.h * zoom))
+            while len(self.chunks) >= self.max_chunks:
+                self.chunks.popitem(last=False)
+        self.chunks[key] = chunk
+        return chunk
+
+    def draw(self, surface, view, zoom):
+        """Draw the terrain inside view, a rect in world coordinates, onto
+        surface scaled by zoom."""
+        size = self.world_chunk_size(zoom)
+        bounds = view.clip(self.source.get_rect())
+        if not bounds:
+            return
+        for chunk_y in range(bounds.top // size, (bounds.bottom - 1) // size + 1):
+            for chunk_x in range(bounds.left // size, (bounds.right - 1) // size + 1):
+                chunk = self.get_chunk(zoom, chunk_x, chunk_y)
+                pos = ((chunk_x * size - view.left) * zoom,
+                       (chunk_y * size - view.top) * zoom)
+                surface.blit(chunk, pos)
+
+    def invalidate(self, rect):
+        """Drop every cached chunk overlapping rect, in world pixels."""
+        for key in list(self.chunks):
+            zoom, chunk_x, chunk_y = key
+            size = self.world_chunk_size(zoom)
+            if rect.colliderect((chunk_x * size, chunk_y * size, size, size)):
+                del self.chunks[key]
+
+    def clear(self):
+        self.chunks.clear()
@@ -0,0 +1,59 @@
+"""
+Builds the game's world on a background thread so the title screen keeps
+drawing while the map is generated or loaded from the world cache.
+"""
+
+import threading
+
+from .. import prepare
+from ..components.hexgrid import HexMap
+from ..components.worldcache import WorldCache
+
+
+class WorldLoader(threading.Thread):
+    """Daemon thread that builds a HexMap. progress (0 to 1) and message
+    describe how far it has got and can be read from the main thread at
+    any time. Once done is True, hex_map holds the world, or error holds
+    the exception that stopped it; call result on the main thread to get
+    the world or re-raise the error there."""
+    def __init__(self, num_rows, num_columns, cell_size, seed=None):
+        super(WorldLoader, self).__init__()
+        self.daemon = True
+        self.num_rows = num_rows
+        self.num_columns = num_columns
+        self.cell_size = cell_size
+        self.seed = seed
+        self.progress = 0.
+        self.message = "Preparing world"
+        self.hex_map = None
+        self.error = None
+        self.done = False
+
+    def report(self, progress, message):
+        self.progress = progress
+        self.message = message
+
+    def run(self):
+        try:
+            if self.seed is None:
+                hex_map = HexMap(self.num_rows, self.num_columns,
+                                 self.cell_size, generate=False)
+                hex_map.generate(progress=self.report)
+            else:
+                self.report(0., "Loading world")
+                cache = WorldCache(prepare.WORLD_CACHE_DIR)
+                hex_map = cache.get(self.num_rows, self.num_columns,
+                                    self.cell_size, self.seed, self.report)
+            self.hex_map = hex_map
+            self.report(1., "Done")
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+
+    def result(self):
+        """Return the finished HexMap, raising the error if building it
+        failed."""
+        if self.error is not None:
+            raise self.error
+        return self.hex_map
@@ -0,0 +1,228 @@
+"""
+Save generated worlds to a compact binary file and load them back, and a
+directory cache of such files keyed on the parameters that determine a
+world: seed, rows, columns and cell size.
+
+A world file is the magic bytes, a header and a zlib-compressed body of
+flat arrays: terrain codes, workers, island ids, each island's population
+and cells, the ports, every port-to-port route, the island inventories and
+the state of the world's random number generator. Everything else (the
+neighbor table, production and consumption rates, the ships) is cheap to
+rebuild from these.
+Ships and the clock are not stored, so a loaded world starts where a
+freshly generated one does, with every ship at its home port.
+"""
+
+import os
+import sys
+import struct
+import zlib
+from array import array
+
+from ..components.hexgrid import HexMap, RouteTable
+
+
+MAGIC = b"HXW"
+VERSION = 2
+#seed, rows, columns, cell width, cell height, islands, ports, routes
+HEADER = struct.Struct("<QIIIIIII")
+ARRAY_HEADER = struct.Struct("<cI")
+
+
+def _to_bytes(values):
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    try:
+        return values.tobytes()
+    except AttributeError:
+        return values.tostring()
+
+
+def _from_bytes(typecode, data):
+    values = array(typecode)
+    try:
+        values.frombytes(data)
+    except AttributeError:
+        values.fromstring(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def _pack_array(values):
+    typecode = values.typecode.encode("ascii")
+    return ARRAY_HEADER.pack(typecode, len(values)) + _to_bytes(values)
+
+
+class _Reader(object):
+    """Reads arrays back out of a world file body in the order they were
+    packed."""
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read_array(self):
+        typecode, length = ARRAY_HEADER.unpack_from(self.data, self.pos)
+        self.pos += ARRAY_HEADER.size
+        typecode = typecode.decode("ascii")
+        size = array(typecode).itemsize * length
+        chunk = self.data[self.pos:self.pos + size]
+        if len(chunk) != size:
+            raise ValueError("Truncated world file")
+        self.pos += size
+        return _from_bytes(typecode, chunk)
+
+
+def _split(values, lengths):
+    """Split the flat array values into lists of the given lengths."""
+    parts = []
+    start = 0
+    for length in lengths:
+        parts.append(values[start:start + length].tolist())
+        start += length
+    return parts
+
+
+def dump_world(hex_map):
+    """Return hex_map as the bytes of a world file."""
+    ports = hex_map.ports
+    route_pairs = [(a, b) for i, a in enumerate(ports) for b in ports[i + 1:]
+                   if hex_map.route_table.get_route(a, b) is not None]
+    routes = [hex_map.route_table.get_route(a, b) for a, b in route_pairs]
+    rng_version, rng_internal, gauss_next = hex_map.rng.getstate()
+    has_gauss = gauss_next is not None
+    header = HEADER.pack(hex_map.seed, hex_map.num_rows, hex_map.num_columns,
+                         hex_map.cell_size[0], hex_map.cell_size[1],
+                         len(hex_map.islands), len(ports), len(routes))
+    arrays = [
+        hex_map.terrain,
+        hex_map.workers,
+        hex_map.island_ids,
+        array("I", [island.population for island in hex_map.islands]),
+        array("I", [len(continent) for continent in hex_map.continents]),
+        array("i", [c.id for continent in hex_map.continents for c in continent]),
+        array("i", [port.id for port in ports]),
+        array("I", [len(route) for route in routes]),
+        array("i", [c.id for route in routes for c in route]),
+        hex_map.ledger.inventory,
+        array("I", [rng_version, has_gauss]),
+        array("I", rng_internal),
+        array("d", [gauss_next if has_gauss else 0.])]
+    body = b"".join(_pack_array(values) for values in arrays)
+    return (MAGIC + struct.pack("<B", VERSION) + header +
+            zlib.compress(body))
+
+
+def parse_world(data):
+    """Return the HexMap held in data, the bytes of a world file. Raises
+    ValueError if data is not a world file this version can read."""
+    prefix_size = len(MAGIC) + 1
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a world file")
+    version, = struct.unpack_from("<B", data, len(MAGIC))
+    if version != VERSION:
+        raise ValueError("Unsupported world file version {}".format(version))
+    (seed, num_rows, num_columns, cell_w, cell_h,
+     num_islands, num_ports, num_routes) = HEADER.unpack_from(data, prefix_size)
+    reader = _Reader(zlib.decompress(data[prefix_size + HEADER.size:]))
+    hex_map = HexMap(num_rows, num_columns, (cell_w, cell_h), seed,
+                     generate=False)
+    for name in ("terrain", "workers", "island_ids"):
+        values = reader.read_array()
+        if len(values) != len(getattr(hex_map, name)):
+            raise ValueError("World file does not match its header")
+        getattr(hex_map, name)[:] = values
+    populations = reader.read_array().tolist()
+    continent_lengths = reader.read_array()
+    continent_ids = _split(reader.read_array(), continent_lengths)
+    port_ids = reader.read_array()
+    route_lengths = reader.read_array()
+    route_ids = _split(reader.read_array(), route_lengths)
+    inventory = reader.read_array()
+    rng_version, has_gauss = reader.read_array()
+    rng_internal = tuple(reader.read_array())
+    gauss_next, = reader.read_array()
+    if (len(populations) != num_islands or len(port_ids) != num_ports or
+            len(route_ids) != num_routes):
+        raise ValueError("World file does not match its header")
+
+    get_cell = hex_map.get_cell
+    hex_map.continents = [[get_cell(i) for i in ids] for ids in continent_ids]
+    hex_map.ports = [get_cell(i) for i in port_ids]
+    hex_map.make_islands(populations)
+    if len(inventory) != len(hex_map.ledger.inventory):
+        raise ValueError("World file does not match its header")
+    hex_map.ledger.inventory[:] = inventory
+    hex_map.rng.setstate((rng_version, rng_internal,
+                          gauss_next if has_gauss else None))
+    route_table = RouteTable()
+    for ids in route_ids:
+        route_table.add_route([get_cell(i) for i in ids])
+    hex_map.make_ships(route_table)
+    return hex_map
+
+
+def save_world(hex_map, path):
+    """Write hex_map to the world file at path. The file is written next
+    to path and renamed into place, so readers never see half a file."""
+    data = dump_world(hex_map)
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            #Windows will not rename over an existing file.
+            os.remove(path)
+            os.rename(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def load_world(path):
+    """Return the HexMap stored in the world file at path."""
+    with open(path, "rb") as f:
+        return parse_world(f.read())
+
+
+class WorldCache(object):
+    """A directory of world files, one per (seed, rows, columns, cell size).
+    get loads a world if it is cached and generates and stores it if not."""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path_for(self, seed, num_rows, num_columns, cell_size):
+        name = "world-{}-{}x{}-{}x{}.hxw".format(seed, num_rows, num_columns,
+                                                 cell_size[0], cell_size[1])
+        return os.path.join(self.directory, name)
+
+    def load(self, seed, num_rows, num_columns, cell_size):
+        """Return the cached world or None if there is no usable file."""
+        path = self.path_for(seed, num_rows, num_columns, cell_size)
+        try:
+            return load_world(path)
+        except (IOError, OSError, ValueError, struct.error, zlib.error):
+            return None
+
+    def get(self, num_rows, num_columns, cell_size, seed, progress=None):
+        """Return the world for these parameters, generating and caching it
+        if it is not already cached. A missing or unreadable file is
+        simply regenerated, reporting to progress as in HexMap.generate.
+        If the world can't be stored (a read-only directory, or a seed
+        outside the file format's 64 bit range) it is returned uncached."""
+        hex_map = self.load(seed, num_rows, num_columns, cell_size)
+        if hex_map is None:
+            hex_map = HexMap(num_rows, num_columns, cell_size, seed,
+                             generate=False)
+            hex_map.generate(progress=progress)
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                save_world(hex_map, self.path_for(seed, num_rows, num_columns,
+                                                  cell_size))
+            except (IOError, OSError, struct.error):
+                pass
+        return hex_map
@@ -3,6 +3,8 @@ from .states import title_screen, gameplay
 
 def main():
     controller = tools.Control(prepare.ORIGINAL_CAPTION)
+    prepare.GFX.preload()
+    prepare.SFX.preload()
     states = {"TITLE": title_screen.TitleScreen(),
                    "GAMEPLAY": gameplay.Gameplay()}
     controller.setup_states(states, "TITLE")
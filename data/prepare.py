@@ -6,16 +6,47 @@ from . import tools
 SCREEN_SIZE = (1080, 740)
 ORIGINAL_CAPTION = "Game"
 
-pg.mixer.pre_init(44100, -16, 1, 512)
+#Set HEXGRID_HEADLESS in the environment before this module is first
+#imported to skip creating a display and loading sounds and images
+#(see data/headless.py).
+HEADLESS = bool(os.environ.get("HEXGRID_HEADLESS"))
 
-pg.init()
-os.environ['SDL_VIDEO_CENTERED'] = "TRUE"
-pg.display.set_caption(ORIGINAL_CAPTION)
-SCREEN = pg.display.set_mode(SCREEN_SIZE)
-SCREEN_RECT = SCREEN.get_rect()
+#Set HEXGRID_SEED to play a fixed world. Seeded worlds are cached in
+#WORLD_CACHE_DIR so they only have to be generated once. World files
+#store the seed in 64 bits, so any other integer is wrapped into that
+#range.
+WORLD_SEED = os.environ.get("HEXGRID_SEED")
+if WORLD_SEED is not None:
+    try:
+        WORLD_SEED = int(WORLD_SEED) % 2**64
+    except ValueError:
+        raise ValueError("HEXGRID_SEED must be an integer, not {!r}".format(WORLD_SEED))
+WORLD_CACHE_DIR = os.path.join("cache", "worlds")
+
+#Rows and columns of hexes in the game's world and the size of a hex.
+WORLD_SIZE = (30, 40)
+CELL_SIZE = (64, 64)
+
+if HEADLESS:
+    SCREEN = None
+    SCREEN_RECT = pg.Rect((0, 0), SCREEN_SIZE)
+else:
+    pg.mixer.pre_init(44100, -16, 1, 512)
+
+    pg.init()
+    os.environ['SDL_VIDEO_CENTERED'] = "TRUE"
+    pg.display.set_caption(ORIGINAL_CAPTION)
+    SCREEN = pg.display.set_mode(SCREEN_SIZE)
+    SCREEN_RECT = SCREEN.get_rect()
 
 
 FONTS = tools.load_all_fonts(os.path.join("resources", "fonts"))
 MUSIC = tools.load_all_music(os.path.join("resources", "music"))
-SFX   = tools.load_all_sfx(os.path.join("resources", "sound"))
-GFX   = tools.load_all_gfx(os.path.join("resources", "graphics"))
+if HEADLESS:
+    SFX = {}
+    GFX = {}
+else:
+    #Sounds and images are loaded the first time they are used; call
+    #preload on SFX or GFX to decode them in the background beforehand.
+    SFX   = tools.lazy_sfx(os.path.join("resources", "sound"))
+    GFX   = tools.lazy_gfx(os.path.join("resources", "graphics"))
@@ -2,7 +2,11 @@ import pygame as pg
 
 from .. import tools, prepare
 from ..components.labels import Label
-from ..components.hexgrid import HexMap, MerchantShip
+from ..components.hexgrid import get_mask, get_atlas
+from ..components.atlas import blit_all
+from ..components.simulation import SimulationWorker
+from ..components.terrain_layer import TerrainLayer, ScaledTerrainCache
+from ..components.world_loader import WorldLoader
 
 
 class InfoWindow(pg.sprite.Sprite):
@@ -24,15 +28,15 @@ class InfoWindow(pg.sprite.Sprite):
 
 
 class ShipWindow(InfoWindow):
-    def __init__(self, ship, mouse_pos):
+    def __init__(self, ship, snapshot, mouse_pos):
         super(ShipWindow, self).__init__(mouse_pos)
-        self.make_labels(ship)
+        self.make_labels(snapshot.cargo[ship.id])
 
-    def make_labels(self, ship):
+    def make_labels(self, cargo):
         labels = pg.sprite.Group()
         Label("Merchant Ship", {"midtop": (self.rect.w//2, 0)}, labels, font_size=14)
         top = 16
-        for good, amt in ship.cargo.items():
+        for good, amt in cargo.items():
             Label(good.title(), {"topleft": (16, top)}, labels, font_size=12)
             Label("{}".format(amt), {"topleft": (64, top)}, labels, font_size=12)
             top += 16
@@ -43,16 +47,16 @@ class ShipWindow(InfoWindow):
 
 
 class TerrainWindow(InfoWindow):
-    def __init__(self, cell, mouse_pos):
+    def __init__(self, cell, snapshot, mouse_pos):
         super(TerrainWindow, self).__init__(mouse_pos)
-        self.make_labels(cell)
+        self.make_labels(cell, snapshot)
 
-    def make_labels(self, cell):
+    def make_labels(self, cell, snapshot):
         labels = pg.sprite.Group()
         Label(cell.terrain.title(), {"midtop": (self.rect.w//2, 0)}, labels, font_size=14)
         if cell.terrain == "port":
             top = 16
-            for good, amt in cell.island.inventory.items():
+            for good, amt in snapshot.island_inventory(cell.island.id).items():
                 Label(good.title(), {"topleft": (16, top)}, labels, font_size=12)
                 Label("{}".format(amt), {"topleft": (64, top)}, labels, font_size=12)
                 top += 16
@@ -77,14 +81,12 @@ class Cursor(pg.sprite.Sprite):
         self.image = pg.Surface((2, 2)).convert_alpha()
         self.image.fill(pg.Color("white"))
         self.rect = self.image.get_rect()
-        self.mask = pg.mask.from_surface(self.image)
 
 
 class Gameplay(tools._State):
-    def __init__(self):
+    def __init__(self, hexmap=None):
         super(Gameplay, self).__init__()
-        self.hexmap = HexMap(30, 40, (64, 64))
-        self.hexmap.make_surface()
+        self.hexmap = None
         self.topleft = (0, 0)
         self.scroll_speed = 4
         self.cursor = Cursor()
@@ -92,9 +94,35 @@ class Gameplay(tools._State):
         self.running = True
         self.zoom_level = 1
         self.zoom_size = prepare.SCREEN_SIZE
+        self.view_surface = None
+        self.zoom_surface = None
+        self.scaled_ships = None
+        self.scaled_ships_zoom = None
+        if hexmap is not None:
+            self.set_world(hexmap)
+
+    def set_world(self, hexmap):
+        """Make hexmap the world being played and start simulating it."""
+        self.hexmap = hexmap
+        self.terrain = TerrainLayer(self.hexmap)
+        self.terrain_cache = ScaledTerrainCache(self.terrain)
+        self.terrain.invalidate_callbacks.append(self.terrain_cache.invalidate)
+        self.worker = SimulationWorker(self.hexmap)
+        self.worker.start()
 
     def startup(self, persistent):
+        """Pick up the world built while the title screen was showing,
+        building it here if the game started without one."""
         self.persist = persistent
+        if self.hexmap is None:
+            hexmap = self.persist.get("hexmap")
+            if hexmap is None:
+                rows, columns = prepare.WORLD_SIZE
+                loader = WorldLoader(rows, columns, prepare.CELL_SIZE,
+                                     prepare.WORLD_SEED)
+                loader.run()
+                hexmap = loader.result()
+            self.set_world(hexmap)
 
     def get_event(self,event):
         if event.type == pg.QUIT:
@@ -107,21 +135,30 @@ class Gameplay(tools._State):
         elif event.type == pg.MOUSEBUTTONUP:
             if event.button == 1:
                 self.window = None
-                for ship in self.hexmap.ships:
-                    if pg.sprite.collide_mask(ship, self.cursor):
-                        self.window = ShipWindow(ship, event.pos)
-                        break
+                snapshot = self.worker.snapshot
+                ship = self.ship_at(self.cursor.rect.topleft, snapshot)
+                if ship is not None:
+                    self.window = ShipWindow(ship, snapshot, event.pos)
             elif event.button == 3:
                 self.window = None
-                for cell in self.hexmap.grid.values():
-                    if pg.sprite.collide_mask(cell, self.cursor):
-                        self.window = TerrainWindow(cell, event.pos)
-                        break
+                cell = self.hexmap.cell_at(self.cursor.rect.topleft)
+                if cell is not None:
+                    self.window = TerrainWindow(cell, self.worker.snapshot, event.pos)
             elif event.button == 4:
                 self.zoom_in()
             elif event.button == 5:
                 self.zoom_out()
 
+    def ship_at(self, world_pos, snapshot):
+        """Return the ship drawn at world_pos in snapshot."""
+        x, y = world_pos
+        nearby = snapshot.ships_near(pg.Rect(world_pos, (1, 1)))
+        for ship, pos, image_name in nearby:
+            rect = pg.Rect(pos, self.hexmap.cell_size)
+            if rect.collidepoint(x, y):
+                if get_mask(image_name).get_at((x - rect.left, y - rect.top)):
+                    return ship
+
     def zoom_in(self):
         self.zoom_level += 1
         w, h = prepare.SCREEN_SIZE
@@ -139,26 +176,66 @@ class Gameplay(tools._State):
         mx, my = mouse_pos
         if mx < 16 and self.topleft[0] > 0:
             self.topleft = self.topleft[0] - self.scroll_speed, self.topleft[1]
-        elif mx > prepare.SCREEN_RECT.right - 16 and self.topleft[0] < self.hexmap.image.get_width() - prepare.SCREEN_RECT.w:
+        elif mx > prepare.SCREEN_RECT.right - 16 and self.topleft[0] < self.hexmap.pixel_size[0] - prepare.SCREEN_RECT.w:
             self.topleft = self.topleft[0] + self.scroll_speed, self.topleft[1]
         if my < 16 and self.topleft[1] > 0:
             self.topleft = self.topleft[0], self.topleft[1] - self.scroll_speed
-        elif my > prepare.SCREEN_RECT.bottom - 16 and self.topleft[1] < self.hexmap.image.get_height() - prepare.SCREEN_RECT.h:
+        elif my > prepare.SCREEN_RECT.bottom - 16 and self.topleft[1] < self.hexmap.pixel_size[1] - prepare.SCREEN_RECT.h:
             self.topleft = self.topleft[0], self.topleft[1] + self.scroll_speed
 
     def update(self, dt):
         mouse_pos = pg.mouse.get_pos()
         self.cursor.rect.topleft = (mouse_pos[0] // self.zoom_level) + self.topleft[0], (mouse_pos[1] // self.zoom_level) + self.topleft[1]
         self.scroll(mouse_pos)
+
+        view = pg.Rect(self.topleft, self.zoom_size)
+        self.terrain.evict(view)
+        if self.zoom_level == 1:
+            self.image = self.render_view(view)
+        else:
+            self.image = self.render_zoomed(view, self.zoom_level)
+
+    def simulate(self, dt):
         if self.running:
-            self.hexmap.update(dt)
-
-        surf = self.hexmap.image.copy()
-        for ship in self.hexmap.ships:
-            ship.draw(surf)
-        self.image = surf.subsurface(self.topleft, self.zoom_size)
-        if self.zoom_level != 1:
-            self.image = pg.transform.scale(self.image, prepare.SCREEN_SIZE)
+            self.worker.advance(dt)
+
+    def render_view(self, view):
+        """Draw the world inside view at normal scale."""
+        if self.view_surface is None or self.view_surface.get_size() != view.size:
+            self.view_surface = pg.Surface(view.size)
+        surf = self.view_surface
+        with tools.PROFILER.section("terrain"):
+            self.terrain.draw_area(surf, view)
+        with tools.PROFILER.section("ships"):
+            atlas = get_atlas()
+            blit_all(surf, [atlas.blit_item(image_name,
+                                            (pos[0] - view.left, pos[1] - view.top))
+                            for ship, pos, image_name
+                            in self.worker.snapshot.ships_near(view)])
+        return surf
+
+    def render_zoomed(self, view, zoom):
+        """Draw the world inside view scaled up to the screen. Terrain comes
+        from the pre-scaled chunk cache; ship images are scaled here into
+        an atlas of their own whenever the zoom level changes."""
+        if self.zoom_surface is None:
+            self.zoom_surface = pg.Surface(prepare.SCREEN_SIZE)
+        surf = self.zoom_surface
+        with tools.PROFILER.section("zoom terrain"):
+            self.terrain_cache.draw(surf, view, zoom)
+        if self.scaled_ships_zoom != zoom:
+            ship_names = [name for name in get_atlas().areas
+                          if name.startswith("ship-")]
+            self.scaled_ships = get_atlas().scaled(zoom, ship_names)
+            self.scaled_ships_zoom = zoom
+        with tools.PROFILER.section("zoom ships"):
+            atlas = self.scaled_ships
+            blit_all(surf, [atlas.blit_item(image_name,
+                                            ((pos[0] - view.left) * zoom,
+                                             (pos[1] - view.top) * zoom))
+                            for ship, pos, image_name
+                            in self.worker.snapshot.ships_near(view)])
+        return surf
 
     def draw(self, surface):
         surface.blit(self.image, (0, 0))
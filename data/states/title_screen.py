@@ -2,15 +2,26 @@ import pygame as pg
 
 from .. import tools, prepare
 from ..components.labels import Label
+from ..components.world_loader import WorldLoader
 
 
 class TitleScreen(tools._State):
     def __init__(self):
         super(TitleScreen, self).__init__()
         self.title = Label("Title Screen", {"midbottom": prepare.SCREEN_RECT.center})
-        
+        self.status = Label("", {"midtop": prepare.SCREEN_RECT.center}, font_size=16)
+        self.loader = None
+        self.start_requested = False
+
     def startup(self, persistent):
+        """Start building the world in the background so it is ready, or
+        nearly, by the time the player clicks."""
         self.persist = persistent
+        if self.loader is None:
+            rows, columns = prepare.WORLD_SIZE
+            self.loader = WorldLoader(rows, columns, prepare.CELL_SIZE,
+                                      prepare.WORLD_SEED)
+            self.loader.start()
         
     def get_event(self,event):
         if event.type == pg.QUIT:
@@ -19,13 +30,26 @@ class TitleScreen(tools._State):
             if event.key == pg.K_ESCAPE:
                 self.quit = True
         elif event.type == pg.MOUSEBUTTONUP:
-            self.done = True
-            self.next = "GAMEPLAY"
+            self.start_requested = True
             
     def update(self, dt):
-        pass
+        """Show the loader's progress and move on to GAMEPLAY once the
+        world is ready and the player has clicked."""
+        if self.loader.done:
+            self.persist["hexmap"] = self.loader.result()
+            if self.start_requested:
+                self.done = True
+                self.next = "GAMEPLAY"
+            text = "Click to start"
+        else:
+            text = "{} ({:.0%})".format(self.loader.message, self.loader.progress)
+            if self.start_requested:
+                text = "Starting soon - " + text
+        if text != self.status.text:
+            self.status.set_text(text)
 
     def draw(self, surface):
         surface.fill(pg.Color("dodgerblue"))
         self.title.draw(surface)
+        self.status.draw(surface)
         
\ No newline at end of file
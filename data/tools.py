@@ -5,21 +5,157 @@ for States.  Also contained here are resource loading functions.
 
 import os
 import copy
+import json
+import math
+import threading
+from collections import deque, OrderedDict
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from contextlib import contextmanager
+from timeit import default_timer
 
 import pygame as pg
 
 
+class FrameProfiler(object):
+    """Times named sections of each frame and keeps the last history frames
+    of each section so slow frames can be traced to the phase that caused
+    them. Wrap a phase in "with PROFILER.section(name):" and call end_frame
+    once per frame; a section entered more than once in a frame is summed.
+    A "frame" section holding the time between end_frame calls is added
+    automatically. Work done on other threads is added one sample at a time
+    with record instead."""
+    def __init__(self, history=300):
+        self.history = history
+        self.samples = OrderedDict()
+        self.lock = threading.Lock()
+        self.current = OrderedDict()
+        self.last_frame = None
+        self.overlay = None
+        self.overlay_age = 0
+        self.font = None
+
+    @contextmanager
+    def section(self, name):
+        start = default_timer()
+        try:
+            yield
+        finally:
+            elapsed = default_timer() - start
+            self.current[name] = self.current.get(name, 0.) + elapsed
+
+    def end_frame(self):
+        """Move this frame's section times, in ms, into the history."""
+        now = default_timer()
+        if self.last_frame is not None:
+            self.current["frame"] = now - self.last_frame
+        self.last_frame = now
+        for name, seconds in self.current.items():
+            self.record(name, seconds * 1000)
+        self.current.clear()
+
+    def record(self, name, ms):
+        """Add a single sample of ms to name's history. Safe to call from
+        any thread, such as the simulation worker timing its steps."""
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.history)
+            self.samples[name].append(ms)
+
+    def get_samples(self):
+        """Return an OrderedDict of section name to a list of its recent
+        samples, copied so other threads can keep recording."""
+        with self.lock:
+            return OrderedDict((name, list(samples))
+                               for name, samples in self.samples.items())
+
+    def summary(self, percentiles=(50, 95, 99)):
+        """Return an OrderedDict of section name to a dict of the sample
+        count, mean, max and the given percentiles of its recent times."""
+        stats = OrderedDict()
+        for name, samples in self.get_samples().items():
+            ordered = sorted(samples)
+            count = len(ordered)
+            stats[name] = section = {"count": count,
+                                     "mean": sum(ordered) / count,
+                                     "max": ordered[-1]}
+            for p in percentiles:
+                rank = max(int(math.ceil(p / 100. * count)) - 1, 0)
+                section["p{}".format(p)] = ordered[rank]
+        return stats
+
+    def export(self, path):
+        """Write the summary and the raw samples of every section to path
+        as JSON."""
+        data = {"history": self.history,
+                "summary": self.summary(),
+                "samples": self.get_samples()}
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2)
+
+    def draw(self, surface, refresh=15):
+        """Draw a table of p50/p95/p99 times per section in the top left of
+        surface. The table is re-rendered every refresh frames."""
+        self.overlay_age -= 1
+        if self.overlay is None or self.overlay_age <= 0:
+            self.overlay = self.render_overlay()
+            self.overlay_age = refresh
+        surface.blit(self.overlay, (4, 4))
+
+    def render_overlay(self):
+        if self.font is None:
+            self.font = pg.font.Font(None, 18)
+        rows = [("ms", "p50", "p95", "p99")]
+        for name, stats in self.summary().items():
+            rows.append((name,) + tuple("{:.2f}".format(stats[p])
+                                        for p in ("p50", "p95", "p99")))
+        line_height = self.font.get_linesize()
+        overlay = pg.Surface((260, line_height * len(rows) + 8)).convert_alpha()
+        overlay.fill((0, 0, 0, 160))
+        for i, row in enumerate(rows):
+            text = self.font.render(row[0], True, pg.Color("white"))
+            overlay.blit(text, (4, 4 + i * line_height))
+            for right, value in zip((150, 200, 250), row[1:]):
+                text = self.font.render(value, True, pg.Color("white"))
+                overlay.blit(text, text.get_rect(topright=(right, 4 + i * line_height)))
+        return overlay
+
+
+#The profiler shared by Control and the states; see FrameProfiler.
+PROFILER = FrameProfiler()
+
+
 class Control(object):
     """Control class for entire project. Contains the game loop, and contains
     the event_loop which passes events to States as needed. Logic for flipping
-    states is also found here."""
+    states is also found here.
+
+    Simulation runs separately from rendering in fixed steps of sim_step
+    ms (about 60 a second). Each frame the real time elapsed, multiplied by
+    time_scale, is added to an accumulator and State.simulate is called
+    once per whole step in it, up to max_steps times per frame. sim_step
+    is a whole number of ms so the simulation clock stays exact and a run
+    does not depend on how its time was split into steps.
+
+    Each frame's phases are timed by PROFILER. F6 shows their recent
+    p50/p95/p99 times on screen and F7 writes them to profile_path."""
     def __init__(self, caption):
         self.screen = pg.display.get_surface()
         self.caption = caption
         self.done = False
         self.clock = pg.time.Clock()
         self.fps = 60.
+        self.sim_step = 16
+        self.max_steps = 120
+        self.time_scales = (1, 10, 100)
+        self.time_scale = 1
+        self.accumulator = 0
         self.show_fps = False
+        self.profiler = PROFILER
+        self.show_profile = False
+        self.profile_path = "frame_profile.json"
         self.current_time = 0.0
         self.keys = pg.key.get_pressed()
         self.state_dict = {}
@@ -29,10 +165,11 @@ class Control(object):
 
     def setup_states(self, state_dict, start_state):
         """Given a dictionary of States and a State to start in,
-        builds the self.state_dict."""
+        builds the self.state_dict and starts up the first State."""
         self.state_dict = state_dict
         self.state_name = start_state
         self.state = self.state_dict[self.state_name]
+        self.state.startup(self.state.persist)
 
     def update(self, dt):
         """Checks if a state is done or has called for a game quit.
@@ -43,8 +180,28 @@ class Control(object):
             self.done = True
         elif self.state.done:
             self.flip_state()
-        self.state.update(dt)
-        self.state.draw(self.screen)
+        #Only queues the steps when the state simulates on another thread;
+        #the steps themselves then show up as "sim step".
+        with self.profiler.section("simulate"):
+            self.simulate(dt)
+        with self.profiler.section("update"):
+            self.state.update(dt)
+        with self.profiler.section("draw"):
+            self.state.draw(self.screen)
+
+    def simulate(self, dt):
+        """Run as many fixed simulation steps as dt ms of real time at the
+        current time_scale calls for. If more than max_steps are due the
+        extra time is dropped so that one slow frame can't snowball."""
+        step = self.sim_step
+        self.accumulator += dt * self.time_scale
+        steps = 0
+        while self.accumulator >= step and steps < self.max_steps:
+            self.state.simulate(step)
+            self.accumulator -= step
+            steps += 1
+        if self.accumulator >= step:
+            self.accumulator %= step
 
     def flip_state(self):
         """When a State changes to done necessary startup and cleanup functions
@@ -64,6 +221,8 @@ class Control(object):
             elif event.type == pg.KEYDOWN:
                 self.keys = pg.key.get_pressed()
                 self.toggle_show_fps(event.key)
+                self.toggle_profile(event.key)
+                self.cycle_time_scale(event.key)
             elif event.type == pg.KEYUP:
                 self.keys = pg.key.get_pressed()
                 self.toggle_fullscreen(event.key)
@@ -76,6 +235,20 @@ class Control(object):
             if not self.show_fps:
                 pg.display.set_caption(self.caption)
 
+    def toggle_profile(self, key):
+        """Press f6 to show or hide the frame profile overlay and f7 to
+        write the profile to profile_path."""
+        if key == pg.K_F6:
+            self.show_profile = not self.show_profile
+        elif key == pg.K_F7:
+            self.profiler.export(self.profile_path)
+
+    def cycle_time_scale(self, key):
+        """Press f2 to step through the simulation speeds in time_scales."""
+        if key == pg.K_F2:
+            i = self.time_scales.index(self.time_scale)
+            self.time_scale = self.time_scales[(i + 1) % len(self.time_scales)]
+
     def toggle_fullscreen(self, key):
         if key == pg.K_F1:
             screen_size = pg.display.get_surface().get_size()
@@ -89,12 +262,18 @@ class Control(object):
         """Main loop for entire program."""
         while not self.done:
             time_delta = self.clock.tick(self.fps)
-            self.event_loop()
+            with self.profiler.section("events"):
+                self.event_loop()
             self.update(time_delta)
-            pg.display.update()
+            if self.show_profile:
+                self.profiler.draw(self.screen)
+            with self.profiler.section("display"):
+                pg.display.update()
+            self.profiler.end_frame()
             if self.show_fps:
                 fps = self.clock.get_fps()
-                with_fps = "{} - {:.2f} FPS".format(self.caption, fps)
+                with_fps = "{} - {:.2f} FPS - x{}".format(self.caption, fps,
+                                                          self.time_scale)
                 pg.display.set_caption(with_fps)
 
 
@@ -133,6 +312,11 @@ class _State(object):
         """Update function for state.  Must be overloaded in children."""
         pass
 
+    def simulate(self, dt):
+        """Advance the state's simulation by one fixed step of dt ms. Called
+        by Control at a fixed rate, independent of the frame rate."""
+        pass
+
     def draw(self, surface):
         pass
         
@@ -169,25 +353,107 @@ class _KwargMixin(object):
 
 
 ### Resource loading functions.
+def convert_gfx(img, colorkey=(0,0,0)):
+    """Convert a loaded image to the display format. If alpha transparency
+    is found in the image it is converted using convert_alpha(), otherwise
+    convert() is used and colorkey is set to colorkey."""
+    if img.get_alpha():
+        return img.convert_alpha()
+    img = img.convert()
+    img.set_colorkey(colorkey)
+    return img
+
+
 def load_all_gfx(directory,colorkey=(0,0,0),accept=(".png",".jpg",".bmp")):
-    """Load all graphics with extensions in the accept argument.  If alpha
-    transparency is found in the image the image will be converted using
-    convert_alpha().  If no alpha transparency is detected image will be
-    converted using convert() and colorkey will be set to colorkey."""
+    """Load all graphics with extensions in the accept argument and convert
+    them with convert_gfx."""
     graphics = {}
     for pic in os.listdir(directory):
         name,ext = os.path.splitext(pic)
         if ext.lower() in accept:
             img = pg.image.load(os.path.join(directory, pic))
-            if img.get_alpha():
-                img = img.convert_alpha()
-            else:
-                img = img.convert()
-                img.set_colorkey(colorkey)
-            graphics[name]=img
+            graphics[name] = convert_gfx(img, colorkey)
     return graphics
 
 
+class LazyAssets(Mapping):
+    """Read-only mapping of name to asset for the files in directory with
+    extensions in accept. Nothing is loaded until an asset is first looked
+    up. decode(path) reads a file and must be safe to call off the main
+    thread; finish(asset), if given, completes it on the main thread (for
+    images, converting to the display format).
+
+    preload decodes every asset on a background thread so later lookups
+    only have to finish them. Lookups never wait on the preload; an asset
+    it hasn't reached yet is simply decoded on the spot."""
+    def __init__(self, directory, accept, decode, finish=None):
+        self.paths = {}
+        for filename in os.listdir(directory):
+            name, ext = os.path.splitext(filename)
+            if ext.lower() in accept:
+                self.paths[name] = os.path.join(directory, filename)
+        self.decode = decode
+        self.finish = finish
+        self.decoded = {}
+        self.loaded = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        try:
+            return self.loaded[name]
+        except KeyError:
+            pass
+        path = self.paths[name]
+        with self.lock:
+            asset = self.decoded.pop(name, None)
+        if asset is None:
+            asset = self.decode(path)
+        if self.finish is not None:
+            asset = self.finish(asset)
+        with self.lock:
+            self.loaded[name] = asset
+            self.decoded.pop(name, None)
+        return asset
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def preload(self, names=None):
+        """Start decoding names (all assets by default) on a daemon thread
+        and return the thread."""
+        if names is None:
+            names = list(self.paths)
+        thread = threading.Thread(target=self._decode_all, args=(names,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _decode_all(self, names):
+        for name in names:
+            if name in self.loaded or name in self.decoded:
+                continue
+            asset = self.decode(self.paths[name])
+            with self.lock:
+                if name not in self.loaded:
+                    self.decoded[name] = asset
+
+
+def lazy_gfx(directory, colorkey=(0,0,0), accept=(".png",".jpg",".bmp")):
+    """A LazyAssets of the graphics in directory, converted as in
+    load_all_gfx when first used."""
+    return LazyAssets(directory, accept, pg.image.load,
+                      lambda img: convert_gfx(img, colorkey))
+
+
+def lazy_sfx(directory, accept=(".wav", ".mp3", ".ogg", ".mdi")):
+    """A LazyAssets of the sounds in directory, loaded as in load_all_sfx
+    when first used."""
+    return LazyAssets(directory, accept, pg.mixer.Sound)
+
+
 def load_all_music(directory, accept=(".wav", ".mp3", ".ogg", ".mdi")):
     """Create a dictionary of paths to music files in given directory
     if their extensions are in accept."""